@@ -91,6 +91,25 @@ def test_send_email(session, csrf_token):
         print("Error sending email:", response.status_code, response.json())
 
 
+# Send Personalised Mail to every row of a CSV in one request
+def test_bulk_send_email(session, csrf_token):
+    headers = {"X-CSRFToken": csrf_token}
+    with open("samplecsv1.csv", "rb") as file:
+        response = session.post(
+            f"{BASE_URL}bulk-send-email/",
+            data={"subject": "Test Email", "message": TEMPLATE},
+            files={"file": file},
+            headers=headers,
+        )
+
+    if response.status_code == 200:
+        print("Bulk email sending started, campaign:", response.json()["campaign_id"])
+        print("Queued emails:", response.json().get("sent_count"))
+        print("Not sent to invalid emails:", response.json().get("not_sent_to"))
+    else:
+        print("Error sending bulk email:", response.status_code, response.json())
+
+
 # Function for AI suggestions
 def ai_suggestion_email(session, csrf_token, data):
     headers = {"X-CSRFToken": csrf_token}
@@ -152,6 +171,9 @@ if __name__ == "__main__":
             print("\nTesting Email Send:")
             test_send_email(session, csrf_token)
 
+            print("\nTesting Bulk Email Send:")
+            test_bulk_send_email(session, csrf_token)
+
             print("\nTesting Email Status:")
             test_email_status(session, csrf_token)
 
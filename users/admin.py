@@ -1,8 +1,26 @@
 from django.contrib import admin
 
-from .models import CustomUser, EmailTemplate, EmailTrack
+from .models import (
+    AIJob,
+    Campaign,
+    CustomUser,
+    DailyDeliveryTotal,
+    DeadLetter,
+    DeliveryCounter,
+    EmailTemplate,
+    EmailTrack,
+    RecipientUpload,
+    Suppression,
+)
 
 # Register your models here
 admin.site.register(CustomUser)
 admin.site.register(EmailTemplate)
+admin.site.register(Campaign)
 admin.site.register(EmailTrack)
+admin.site.register(RecipientUpload)
+admin.site.register(DeliveryCounter)
+admin.site.register(DeadLetter)
+admin.site.register(DailyDeliveryTotal)
+admin.site.register(Suppression)
+admin.site.register(AIJob)
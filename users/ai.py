@@ -0,0 +1,368 @@
+import asyncio
+import atexit
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import httpx
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+SUBJECT_PROMPT = (
+    "Generate a one-line email subject within 10 words for: : {description}"
+)
+BODY_PROMPT = "Do not create subject. Write an email body for: {description}"
+OPENER_PROMPT = (
+    "Write a one or two sentence personal opening line for an email about: "
+    "{description}. The recipient's details are: {details}. "
+    "Reply with the opening line only."
+)
+
+# All Ollama calls run on one long-lived event loop in a background thread,
+# so the process shares one pooled client whether it serves WSGI requests or
+# Celery tasks. Created on first use, closed at exit.
+_loop = None
+_loop_lock = threading.Lock()
+_client = None
+_DONE = object()
+
+
+class OllamaError(Exception):
+    pass
+
+
+def normalise_description(description):
+    # "New Year Sale" and "new year sale!" ask for the same thing
+    text = unicodedata.normalize("NFKC", description).casefold()
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+
+class SuggestionCache:
+    """LRU cache of generated suggestions with a time to live.
+
+    Entries are keyed on the model and the normalised description. When an
+    embedding is stored with an entry, ``nearest`` can also match a new
+    description that means nearly the same thing.
+    """
+
+    def __init__(self, max_size=None, ttl=None, clock=time.monotonic):
+        self.max_size = max_size or settings.AI_SUGGESTION_CACHE_SIZE
+        self.ttl = ttl or settings.AI_SUGGESTION_CACHE_TTL
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.similar_hits = self.misses = 0
+
+    def get(self, description, model):
+        key = (model, normalise_description(description))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry["expires"] <= self.clock():
+                self.entries.pop(key, None)
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry["value"]
+
+    def nearest(self, embedding, model, threshold):
+        # Best cosine match among live entries of the same model
+        with self.lock:
+            now = self.clock()
+            candidates = [
+                (key, entry)
+                for key, entry in self.entries.items()
+                if key[0] == model
+                and entry["embedding"] is not None
+                and entry["expires"] > now
+            ]
+            if not candidates:
+                return None
+            vectors = np.array([entry["embedding"] for _, entry in candidates])
+            query = np.asarray(embedding)
+            norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+            scores = vectors @ query / np.where(norms == 0, 1, norms)
+            best = int(np.argmax(scores))
+            if scores[best] < threshold:
+                return None
+            key, entry = candidates[best]
+            self.entries.move_to_end(key)
+            self.similar_hits += 1
+            return entry["value"]
+
+    def set(self, description, model, value, embedding=None):
+        key = (model, normalise_description(description))
+        with self.lock:
+            self.entries[key] = {
+                "value": value,
+                "embedding": embedding,
+                "expires": self.clock() + self.ttl,
+            }
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def record_miss(self):
+        with self.lock:
+            self.misses += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.similar_hits + self.misses
+            return {
+                "hits": self.hits,
+                "similar_hits": self.similar_hits,
+                "misses": self.misses,
+                "hit_rate": (
+                    (self.hits + self.similar_hits) / lookups if lookups else 0.0
+                ),
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+            }
+
+
+_suggestion_cache = None
+
+
+def get_suggestion_cache():
+    global _suggestion_cache
+    if _suggestion_cache is None:
+        _suggestion_cache = SuggestionCache()
+    return _suggestion_cache
+
+
+def get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="ollama-loop", daemon=True
+            ).start()
+        return _loop
+
+
+def _forget_loop():
+    # A forked child (Celery prefork) has the loop but not its thread
+    global _loop, _client
+    _loop = _client = None
+
+
+os.register_at_fork(after_in_child=_forget_loop)
+
+
+def run(coro):
+    # Run a coroutine on the shared loop and wait for its result
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+
+def iterate(agen):
+    """Iterate an async generator from synchronous code, such as a WSGI view.
+
+    The generator runs on the shared loop and hands each item over as soon
+    as it's produced. Closing the iterator cancels the generator.
+    """
+    items = queue.Queue()
+
+    async def pump():
+        try:
+            async for item in agen:
+                items.put(item)
+        finally:
+            items.put(_DONE)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), get_loop())
+    try:
+        while (item := items.get()) is not _DONE:
+            yield item
+        # Re-raise anything the generator failed with
+        future.result()
+    finally:
+        future.cancel()
+
+
+def get_client():
+    # Only called on the shared loop, which owns the client
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            base_url=settings.OLLAMA_URL,
+            timeout=settings.OLLAMA_TIMEOUT,
+            limits=httpx.Limits(max_connections=settings.OLLAMA_MAX_CONNECTIONS),
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        client, _client = _client, None
+        await client.aclose()
+
+
+@atexit.register
+def shutdown():
+    if _loop is not None and _loop.is_running():
+        run(close_client())
+        _loop.call_soon_threadsafe(_loop.stop)
+
+
+async def stream_completion(prompt, model=None):
+    # Yield the model's tokens as Ollama produces them
+    payload = {"model": model or settings.OLLAMA_MODEL, "prompt": prompt}
+    async with get_client().stream("POST", "/api/generate", json=payload) as response:
+        if response.status_code != 200:
+            await response.aread()
+            raise OllamaError(
+                f"Ollama returned {response.status_code}: {response.text}"
+            )
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if "error" in chunk:
+                raise OllamaError(chunk["error"])
+            if chunk.get("response"):
+                yield chunk["response"]
+            if chunk.get("done"):
+                break
+
+
+async def generate(prompt, model=None):
+    return "".join([token async for token in stream_completion(prompt, model)])
+
+
+async def embed(text):
+    response = await get_client().post(
+        "/api/embed", json={"model": settings.OLLAMA_EMBED_MODEL, "input": text}
+    )
+    if response.status_code != 200:
+        raise OllamaError(f"Ollama returned {response.status_code}: {response.text}")
+    return response.json()["embeddings"][0]
+
+
+async def cached_suggestions(description, model):
+    """Look a description up in the suggestion cache.
+
+    Returns the cached suggestions (or None) and, when similarity matching
+    is on, the description's embedding so a miss can be stored with it.
+    """
+    cache = get_suggestion_cache()
+    suggestions = cache.get(description, model)
+    if suggestions is not None:
+        return suggestions, None
+
+    embedding = None
+    if settings.AI_SUGGESTION_SIMILARITY:
+        try:
+            embedding = await embed(normalise_description(description))
+            suggestions = cache.nearest(
+                embedding, model, settings.AI_SUGGESTION_SIMILARITY
+            )
+        except (httpx.HTTPError, OllamaError) as e:
+            # Exact matches still work without the embedding model
+            logger.warning(f"Error embedding description: {str(e)}")
+    if suggestions is None:
+        cache.record_miss()
+    return suggestions, embedding
+
+
+async def generate_suggestions(description, model=None):
+    model = model or settings.OLLAMA_MODEL
+    suggestions, embedding = await cached_suggestions(description, model)
+    if suggestions is not None:
+        return suggestions
+
+    # Subject and body are independent, so generate them side by side
+    subject, body = await asyncio.gather(
+        generate(SUBJECT_PROMPT.format(description=description), model),
+        generate(BODY_PROMPT.format(description=description), model),
+    )
+    suggestions = {"subject": subject.strip(), "body": body.strip()}
+    get_suggestion_cache().set(description, model, suggestions, embedding)
+    return suggestions
+
+
+async def stream_suggestions(description, model=None):
+    """Yield ``{"field", "token"}`` events for subject and body as they arrive.
+
+    Both generations run concurrently and their tokens are interleaved. An
+    ``{"error"}`` event ends the stream as soon as either one fails. Cached
+    suggestions come back as one event per field.
+    """
+    model = model or settings.OLLAMA_MODEL
+    suggestions, embedding = await cached_suggestions(description, model)
+    if suggestions is not None:
+        for field, text in suggestions.items():
+            yield {"field": field, "token": text}
+        return
+
+    queue = asyncio.Queue()
+    prompts = {"subject": SUBJECT_PROMPT, "body": BODY_PROMPT}
+    generated = dict.fromkeys(prompts, "")
+
+    async def pump(field, prompt):
+        try:
+            async for token in stream_completion(
+                prompt.format(description=description), model
+            ):
+                await queue.put({"field": field, "token": token})
+        except (httpx.HTTPError, OllamaError) as e:
+            logger.error(f"Error generating {field}: {str(e)}")
+            await queue.put({"error": f"Error generating content: {str(e)}"})
+        finally:
+            await queue.put(None)
+
+    tasks = [asyncio.create_task(pump(*item)) for item in prompts.items()]
+    try:
+        finished = 0
+        while finished < len(tasks):
+            event = await queue.get()
+            if event is None:
+                finished += 1
+                continue
+            yield event
+            if "error" in event:
+                return
+            generated[event["field"]] += event["token"]
+    finally:
+        # Stop generating if the browser went away or one side failed
+        for task in tasks:
+            task.cancel()
+
+    suggestions = {field: text.strip() for field, text in generated.items()}
+    get_suggestion_cache().set(description, model, suggestions, embedding)
+
+
+async def personalise_openers(description, rows, model=None, concurrency=None):
+    """Generate a personal opening line for every recipient row, in order.
+
+    Up to ``concurrency`` prompts are in flight at once, so the model stays
+    busy without queueing the whole upload on it. A row whose generation
+    fails gets an empty opener.
+    """
+    semaphore = asyncio.Semaphore(concurrency or settings.AI_BATCH_CONCURRENCY)
+
+    async def opener(row):
+        details = ", ".join(
+            f"{column}: {value}"
+            for column, value in row.items()
+            if column != "email" and value
+        )
+        prompt = OPENER_PROMPT.format(description=description, details=details)
+        async with semaphore:
+            try:
+                return (await generate(prompt, model)).strip()
+            except (httpx.HTTPError, OllamaError) as e:
+                logger.error(f"Error personalising email to {row['email']}: {str(e)}")
+                return ""
+
+    return await asyncio.gather(*(opener(row) for row in rows))
@@ -0,0 +1,121 @@
+import logging
+from datetime import timedelta
+
+import pandas as pd
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, F, OuterRef
+from django.utils import timezone
+
+from .models import DailyDeliveryTotal, DeadLetter, EmailTrack
+from .tracking import FINISHED_STATUSES
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_COLUMNS = [
+    "id",
+    "username_id",
+    "campaign_id",
+    "recipient",
+    "status",
+    "email_sent_date",
+    "subject",
+    "message",
+    "smtp_code",
+    "smtp_response",
+    "status_updated_at",
+    "sent_at",
+]
+ARCHIVE_EXTENSIONS = {"csv": "csv.gz", "parquet": "parquet"}
+
+
+def archive_cutoff(days=None):
+    # Midnight UTC, so a day's rows are always archived together
+    days = settings.EMAIL_ARCHIVE_AFTER_DAYS if days is None else days
+    before = timezone.now() - timedelta(days=days)
+    return before.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def archivable_tracks(before):
+    # Finished rows only, and none a dead letter still needs for a replay
+    pending_replay = DeadLetter.objects.filter(
+        track=OuterRef("pk"), replayed_at__isnull=True
+    )
+    return EmailTrack.objects.filter(
+        email_sent_date__lt=before, status__in=FINISHED_STATUSES
+    ).exclude(Exists(pending_replay))
+
+
+def archive_email_tracks(before, archive_dir=None, fmt=None, batch_size=None):
+    """Move EmailTrack rows sent before ``before`` into compressed files.
+
+    Each batch is written to one file per month under ``archive_dir``
+    (``2025-01/emailtrack-<first id>.csv.gz``), then rolled up into
+    DailyDeliveryTotal and deleted. A batch whose delete never ran is
+    written again to the same file on the next run. Returns the number of
+    rows archived.
+    """
+    archive_dir = archive_dir or settings.EMAIL_ARCHIVE_DIR
+    fmt = fmt or settings.EMAIL_ARCHIVE_FORMAT
+    batch_size = batch_size or settings.EMAIL_ARCHIVE_BATCH_SIZE
+    tracks = archivable_tracks(before).order_by("id").values_list(*ARCHIVE_COLUMNS)
+
+    archived = 0
+    while True:
+        # Archived rows are deleted, so the next batch is always the first
+        rows = pd.DataFrame(list(tracks[:batch_size]), columns=ARCHIVE_COLUMNS)
+        if rows.empty:
+            break
+        sent_dates = pd.to_datetime(rows["email_sent_date"], utc=True)
+        for month, group in rows.groupby(sent_dates.dt.strftime("%Y-%m")):
+            write_archive(group, archive_dir / month, fmt)
+
+        with transaction.atomic():
+            add_daily_totals(rows, sent_dates.dt.date)
+            EmailTrack.objects.filter(id__in=rows["id"].tolist()).delete()
+        archived += len(rows)
+        logger.info(f"Archived {archived} email tracking rows")
+    return archived
+
+
+def write_archive(rows, directory, fmt):
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"emailtrack-{rows['id'].iloc[0]}.{ARCHIVE_EXTENSIONS[fmt]}"
+    rows = rows.assign(campaign_id=rows["campaign_id"].map(str, na_action="ignore"))
+    if fmt == "parquet":
+        # Needs pyarrow or fastparquet installed
+        rows.to_parquet(path, index=False)
+    else:
+        rows.to_csv(path, index=False, compression="gzip")
+
+
+def add_daily_totals(rows, days):
+    counts = (
+        rows.assign(day=days)
+        .groupby(["username_id", "campaign_id", "day", "status"], dropna=False)
+        .size()
+    )
+    for (user_id, campaign_id, day, status), count in counts.items():
+        campaign_id = None if pd.isna(campaign_id) else campaign_id
+        # For the user as a whole, then per campaign (as DeliveryCounter)
+        for scope in {None, campaign_id}:
+            increment_daily_total(user_id, scope, day, status, int(count))
+
+
+def increment_daily_total(user_id, campaign_id, day, status, delta):
+    totals = DailyDeliveryTotal.objects.filter(
+        username_id=user_id, campaign_id=campaign_id, day=day, status=status
+    )
+    if totals.update(count=F("count") + delta):
+        return
+    try:
+        with transaction.atomic():
+            DailyDeliveryTotal.objects.create(
+                username_id=user_id,
+                campaign_id=campaign_id,
+                day=day,
+                status=status,
+                count=delta,
+            )
+    except IntegrityError:
+        totals.update(count=F("count") + delta)
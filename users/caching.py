@@ -0,0 +1,92 @@
+import hashlib
+import json
+import logging
+import time
+
+import redis
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils.cache import patch_cache_control
+from rest_framework import status
+from rest_framework.response import Response
+
+logger = logging.getLogger(__name__)
+
+# Cached per-user responses
+TEMPLATES = "templates"
+EMAIL_STATUS = "email-status"
+
+
+def version_key(scope, user_id):
+    return f"response-version:{scope}:{user_id}"
+
+
+def cache_version(scope, user_id):
+    # Every cached entry embeds the version, so bumping it drops all of the
+    # user's entries for the scope (every page and query string) at once
+    key = version_key(scope, user_id)
+    version = cache.get(key)
+    if version is None:
+        # Start from the clock so an evicted version can't revive old entries
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+def invalidate_user_cache(scope, user_id):
+    # Once the change is committed, so a request in between can't cache the
+    # old data again and a cache outage can't roll the change back
+    transaction.on_commit(lambda: bump_cache_version(scope, user_id))
+
+
+def bump_cache_version(scope, user_id):
+    try:
+        try:
+            cache.incr(version_key(scope, user_id))
+        except ValueError:
+            cache.set(version_key(scope, user_id), time.time_ns(), None)
+    except redis.RedisError as e:
+        # Entries expire after RESPONSE_CACHE_TIMEOUTS regardless
+        logger.warning(f"Response cache unavailable, {scope} not invalidated: {e}")
+
+
+def cached_response(request, scope, build):
+    """Serve ``build()``'s data from the user's cache, with ETag revalidation.
+
+    The entry is keyed on the full path, so each page or filter is cached
+    separately. A matching If-None-Match gets an empty 304.
+    """
+    key = entry = None
+    try:
+        version = cache_version(scope, request.user.id)
+        key = f"response:{scope}:{request.user.id}:{version}:{request.get_full_path()}"
+        entry = cache.get(key)
+    except redis.RedisError as e:
+        # Serve straight from the database while the cache is down
+        logger.warning(f"Response cache unavailable, building {scope}: {e}")
+
+    if entry is None:
+        data = build()
+        body = json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True)
+        entry = {"etag": f'"{hashlib.sha1(body.encode()).hexdigest()}"', "data": data}
+        if key:
+            try:
+                cache.set(key, entry, settings.RESPONSE_CACHE_TIMEOUTS[scope])
+            except redis.RedisError as e:
+                logger.warning(f"Response cache unavailable, {scope} not stored: {e}")
+
+    if entry["etag"] in if_none_match(request):
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = Response(entry["data"], status=status.HTTP_200_OK)
+    response["ETag"] = entry["etag"]
+    # Let the browser keep a copy but check back every time
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def if_none_match(request):
+    header = request.headers.get("If-None-Match", "")
+    return {tag.strip().removeprefix("W/") for tag in header.split(",")}
@@ -0,0 +1,110 @@
+from collections import Counter
+from functools import lru_cache
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+
+from .caching import EMAIL_STATUS, invalidate_user_cache
+from .models import Campaign, DailyDeliveryTotal, DeliveryCounter, EmailTrack
+
+
+@lru_cache(maxsize=1024)
+def campaign_owner(campaign_id):
+    # A campaign never changes owner, so workers look it up once
+    return Campaign.objects.values_list("username_id", flat=True).get(id=campaign_id)
+
+
+def record_status_changes(campaign_id, changes, user_id=None):
+    """Apply ``{status: delta}`` to the campaign's and its owner's counters.
+
+    Each counter row is bumped with an atomic F() increment, so concurrent
+    workers never overwrite each other's totals.
+    """
+    if not user_id:
+        try:
+            user_id = campaign_owner(campaign_id)
+        except Campaign.DoesNotExist:
+            # Deleted mid-send, its tracking rows and counters went with it
+            return
+    for status, delta in changes.items():
+        if not delta:
+            continue
+        # The user's overall counter, then the campaign's
+        for scope in (None, campaign_id):
+            increment_counter(user_id, status, delta, scope)
+    # The dashboard shows these counts, so its cached responses are stale
+    invalidate_user_cache(EMAIL_STATUS, user_id)
+
+
+def increment_counter(user_id, status, delta, campaign_id=None):
+    counters = DeliveryCounter.objects.filter(
+        username_id=user_id,
+        campaign_id=campaign_id,
+        status=status,
+    )
+    if counters.update(count=F("count") + delta):
+        return
+    try:
+        # First change for this status; another worker may create it first
+        with transaction.atomic():
+            DeliveryCounter.objects.create(
+                username_id=user_id, campaign_id=campaign_id, status=status, count=delta
+            )
+    except IntegrityError:
+        counters.update(count=F("count") + delta)
+
+
+def user_status_counts(user):
+    # Counters for the user as a whole, summed into the dashboard groups
+    counts = dict.fromkeys(EmailTrack.STATUS_GROUPS, 0)
+    rows = DeliveryCounter.objects.filter(
+        username=user, campaign__isnull=True
+    ).values_list("status", "count")
+    for status, count in rows:
+        for name, statuses in EmailTrack.STATUS_GROUPS.items():
+            if status in statuses:
+                counts[name] += count
+    return counts
+
+
+def rebuild_counters(user_ids=None):
+    """Recount every counter from EmailTrack and the archived daily totals,
+    optionally for some users only."""
+    tracks = EmailTrack.objects.all()
+    archived = DailyDeliveryTotal.objects.all()
+    counters = DeliveryCounter.objects.all()
+    if user_ids:
+        tracks = tracks.filter(username_id__in=user_ids)
+        archived = archived.filter(username_id__in=user_ids)
+        counters = counters.filter(username_id__in=user_ids)
+
+    # Per-campaign rows, then the per-user totals. Legacy rows with no
+    # campaign only count towards the user totals.
+    totals = Counter()
+    rows = tracks.values_list("username_id", "campaign_id", "status")
+    for user_id, campaign_id, status, total in rows.annotate(
+        total=Count("id")
+    ).order_by():
+        if campaign_id:
+            totals[user_id, campaign_id, status] += total
+        totals[user_id, None, status] += total
+    # Archived totals already carry their own per-user rows
+    rows = archived.values_list("username_id", "campaign_id", "status")
+    for user_id, campaign_id, status, total in rows.annotate(
+        total=Sum("count")
+    ).order_by():
+        totals[user_id, campaign_id, status] += total
+
+    rows = [
+        DeliveryCounter(
+            username_id=user_id, campaign_id=campaign_id, status=status, count=count
+        )
+        for (user_id, campaign_id, status), count in totals.items()
+    ]
+    with transaction.atomic():
+        counters.delete()
+        DeliveryCounter.objects.bulk_create(rows, batch_size=1000)
+    user_rows = [row for row in rows if row.campaign_id is None]
+    for user_id in {row.username_id for row in user_rows}:
+        invalidate_user_cache(EMAIL_STATUS, user_id)
+    return len(user_rows)
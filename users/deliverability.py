@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import time
+
+import dns.asyncresolver
+import dns.exception
+import dns.name
+import dns.resolver
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+
+async def resolve_domain(resolver, domain):
+    # True if the domain takes mail, False if it can't, None if DNS didn't say
+    try:
+        answer = await resolver.resolve(domain, "MX")
+        # A lone "." exchange is a null MX (RFC 7505): the domain takes no mail
+        return any(record.exchange != dns.name.root for record in answer)
+    except dns.resolver.NXDOMAIN:
+        return False
+    except dns.resolver.NoAnswer:
+        pass
+    except dns.exception.DNSException as e:
+        # Timeouts and unreachable nameservers say nothing about the domain
+        logger.warning(f"MX lookup for {domain} failed: {str(e)}")
+        return None
+
+    # Without MX records mail goes to the domain's own address
+    for rdtype in ("A", "AAAA"):
+        try:
+            await resolver.resolve(domain, rdtype)
+            return True
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            continue
+        except dns.exception.DNSException as e:
+            logger.warning(f"{rdtype} lookup for {domain} failed: {str(e)}")
+            return None
+    return False
+
+
+class DeliverabilityChecker:
+    """Checks that recipient domains can receive mail, one DNS lookup per domain.
+
+    Answers are kept in the Django cache, so with a shared cache backend every
+    process and worker reuses them; domains that can't take mail are cached
+    for ``negative_ttl``. Lookups that time out, or are still running at the
+    deadline, are not cached.
+    """
+
+    def __init__(
+        self,
+        resolver=None,
+        concurrency=None,
+        ttl=None,
+        negative_ttl=None,
+        deadline=None,
+    ):
+        self.resolver = resolver
+        self.concurrency = concurrency or settings.EMAIL_MX_CONCURRENCY
+        self.deadline = deadline or settings.EMAIL_MX_DEADLINE
+        self.ttl = ttl or settings.EMAIL_MX_CACHE_TTL
+        self.negative_ttl = negative_ttl or settings.EMAIL_MX_NEGATIVE_CACHE_TTL
+
+    def cache_key(self, domain):
+        return f"mx:{domain}"
+
+    def start_deadline(self):
+        # Monotonic time by which a whole upload's lookups must be done
+        return time.monotonic() + self.deadline
+
+    def check(self, domains, deadline=None):
+        # {domain: True/False/None} for the distinct lower-cased domains.
+        # Callers checking an upload in chunks pass one deadline for all.
+        domains = list(dict.fromkeys(domain.lower() for domain in domains))
+        cached = cache.get_many([self.cache_key(domain) for domain in domains])
+        results = {
+            domain: cached[self.cache_key(domain)]
+            for domain in domains
+            if self.cache_key(domain) in cached
+        }
+        missing = [domain for domain in domains if domain not in results]
+        if not missing:
+            return results
+
+        deadline = deadline or self.start_deadline()
+        resolved = async_to_sync(self.resolve_all)(missing, deadline)
+        for deliverable, ttl in ((True, self.ttl), (False, self.negative_ttl)):
+            cache.set_many(
+                {
+                    self.cache_key(domain): deliverable
+                    for domain, result in resolved.items()
+                    if result is deliverable
+                },
+                ttl,
+            )
+        results.update(resolved)
+        return results
+
+    async def resolve_all(self, domains, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            # Spent on earlier chunks; these go unanswered
+            return dict.fromkeys(domains)
+        resolver = self.resolver or self.default_resolver()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def resolve(domain):
+            async with semaphore:
+                return await resolve_domain(resolver, domain)
+
+        tasks = {domain: asyncio.create_task(resolve(domain)) for domain in domains}
+        # Bound the whole check, not just each lookup, so an upload full of
+        # slow domains can't hold the request
+        _, unfinished = await asyncio.wait(tasks.values(), timeout=remaining)
+        for task in unfinished:
+            task.cancel()
+        await asyncio.gather(*unfinished, return_exceptions=True)
+        if unfinished:
+            logger.warning(f"{len(unfinished)} domain lookups missed the deadline")
+        return {
+            domain: None if task in unfinished else task.result()
+            for domain, task in tasks.items()
+        }
+
+    def default_resolver(self):
+        resolver = dns.asyncresolver.Resolver()
+        resolver.lifetime = settings.EMAIL_MX_TIMEOUT
+        return resolver
+
+
+_deliverability_checker = None
+
+
+def get_deliverability_checker():
+    global _deliverability_checker
+    if _deliverability_checker is None:
+        _deliverability_checker = DeliverabilityChecker()
+    return _deliverability_checker
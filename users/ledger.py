@@ -0,0 +1,61 @@
+import logging
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def idempotency_key(campaign_id, email):
+    return f"{campaign_id}:{email.strip().lower()}"
+
+
+class SendLedger:
+    """Records every delivered (campaign, recipient) pair the moment it is sent.
+
+    Tracking rows are written in batches, so after a crash the ledger is what
+    tells a restarted chunk who already got the message. Keys live in one
+    Redis set per campaign and expire after ``ttl`` seconds.
+    """
+
+    def __init__(self, client, ttl=None):
+        self.client = client
+        self.ttl = ttl or settings.EMAIL_SEND_LEDGER_TTL
+
+    def set_key(self, campaign_id):
+        return f"email-sent:{campaign_id}"
+
+    def sent(self, campaign_id, emails):
+        # Which of emails were already delivered for this campaign
+        keys = [idempotency_key(campaign_id, email) for email in emails]
+        if not keys:
+            return set()
+        try:
+            found = self.client.smismember(self.set_key(campaign_id), keys)
+        except redis.RedisError as e:
+            # The tracking rows still stop anything flushed from going out twice
+            logger.warning(f"Send ledger unavailable, resuming from tracking: {e}")
+            return set()
+        return {email for email, hit in zip(emails, found) if hit}
+
+    def record(self, campaign_id, email):
+        key = self.set_key(campaign_id)
+        try:
+            with self.client.pipeline() as pipe:
+                pipe.sadd(key, idempotency_key(campaign_id, email))
+                pipe.expire(key, self.ttl)
+                pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Send ledger unavailable, {email} not recorded: {e}")
+
+
+_send_ledger = None
+
+
+def get_send_ledger():
+    global _send_ledger
+    if _send_ledger is None:
+        _send_ledger = SendLedger(
+            redis.Redis.from_url(settings.EMAIL_SEND_LEDGER_REDIS_URL)
+        )
+    return _send_ledger
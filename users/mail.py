@@ -0,0 +1,73 @@
+import logging
+from smtplib import SMTPServerDisconnected
+
+from celery.signals import worker_process_shutdown
+from django.conf import settings
+from django.core.mail import get_connection
+
+logger = logging.getLogger(__name__)
+
+
+class PooledConnection:
+    """SMTP connection that stays open across sends.
+
+    The connection is opened lazily, reopened once if the server drops it and
+    recycled after ``max_messages`` messages so long-lived workers do not hit
+    provider per-connection limits.
+    """
+
+    def __init__(self, max_messages=None, backend=None):
+        self.max_messages = max_messages or settings.EMAIL_CONNECTION_MAX_MESSAGES
+        self.backend = backend
+        self.connection = None
+        self.sent_count = 0
+
+    def open(self):
+        if self.connection is None:
+            self.connection = get_connection(backend=self.backend, fail_silently=False)
+            self.connection.open()
+            self.sent_count = 0
+        return self.connection
+
+    def close(self):
+        if self.connection is None:
+            return
+        try:
+            self.connection.close()
+        except Exception as e:
+            logger.warning(f"Error closing SMTP connection: {str(e)}")
+        self.connection = None
+
+    def send(self, message):
+        connection = self.open()
+        try:
+            sent = connection.send_messages([message])
+        except (SMTPServerDisconnected, ConnectionError) as e:
+            # Idle connections get dropped by the server, retry once on a fresh one
+            logger.warning(f"SMTP connection dropped ({str(e)}), reconnecting...")
+            self.close()
+            connection = self.open()
+            sent = connection.send_messages([message])
+
+        self.sent_count += sent
+        if self.sent_count >= self.max_messages:
+            logger.info(f"Recycling SMTP connection after {self.sent_count} messages")
+            self.close()
+        return sent
+
+
+_pooled_connection = None
+
+
+def get_pooled_connection():
+    # One connection per worker process, reused across tasks
+    global _pooled_connection
+    if _pooled_connection is None:
+        _pooled_connection = PooledConnection()
+    return _pooled_connection
+
+
+@worker_process_shutdown.connect
+def close_pooled_connection(**kwargs):
+    if _pooled_connection is not None:
+        _pooled_connection.close()
@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from users.archive import ARCHIVE_EXTENSIONS, archive_cutoff, archive_email_tracks
+
+
+class Command(BaseCommand):
+    help = (
+        "Move old EmailTrack rows into compressed monthly archive files, "
+        "keeping their daily totals"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.EMAIL_ARCHIVE_AFTER_DAYS,
+            help="Archive rows sent more than this many days ago",
+        )
+        parser.add_argument(
+            "--format",
+            choices=list(ARCHIVE_EXTENSIONS),
+            default=settings.EMAIL_ARCHIVE_FORMAT,
+            help="csv writes csv.gz files; parquet needs pyarrow",
+        )
+
+    def handle(self, *args, **options):
+        before = archive_cutoff(options["days"])
+        archived = archive_email_tracks(before, fmt=options["format"])
+        self.stdout.write(
+            f"Archived {archived} email tracking rows sent before {before:%Y-%m-%d}"
+        )
@@ -0,0 +1,92 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from users.models import Campaign, EmailTrack
+
+
+class Command(BaseCommand):
+    help = (
+        "Fold EmailTrack rows written before campaigns existed into Campaign rows "
+        "and drop their duplicated subject and message"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--gap",
+            type=int,
+            default=60,
+            help="Seconds between rows with the same subject and message "
+            "after which they count as a separate send",
+        )
+        parser.add_argument(
+            "--vacuum",
+            action="store_true",
+            help="Run VACUUM afterwards so SQLite returns the freed space",
+        )
+
+    def handle(self, *args, **options):
+        gap = timedelta(seconds=options["gap"])
+        legacy = (
+            EmailTrack.objects.filter(campaign__isnull=True)
+            .order_by("id")
+            .values_list(
+                "id", "username_id", "status", "subject", "message", "email_sent_date"
+            )
+        )
+
+        # Rows from one send were written back to back, so consecutive rows
+        # with the same owner, subject and message form one campaign
+        campaigns = 0
+        group = []
+        last_id = 0
+        while True:
+            # Read in keyset pages so no cursor is open while rows are updated
+            page = list(legacy.filter(id__gt=last_id)[:2000])
+            if not page:
+                break
+            last_id = page[-1][0]
+
+            for row in page:
+                if group:
+                    same_send = self.send_key(row) == self.send_key(group[0])
+                    if not same_send or row[5] - group[-1][5] > gap:
+                        self.fold(group)
+                        campaigns += 1
+                        group = []
+                group.append(row)
+
+        if group:
+            self.fold(group)
+            campaigns += 1
+
+        self.stdout.write(f"Folded legacy tracking rows into {campaigns} campaigns")
+
+        if options["vacuum"] and connection.vendor == "sqlite":
+            with connection.cursor() as cursor:
+                cursor.execute("VACUUM")
+
+    def send_key(self, row):
+        # Owner, subject and message
+        return row[1], row[3], row[4]
+
+    def fold(self, group):
+        _, username_id, _, subject, message, created_at = group[0]
+        with transaction.atomic():
+            campaign = Campaign.objects.create(
+                username_id=username_id,
+                subject=subject,
+                body=message,
+                total_recipients=len(group),
+                sent_count=sum(1 for row in group if row[2] == "success"),
+                failed_count=sum(1 for row in group if row[2] == "fail"),
+                finished_at=group[-1][5],
+            )
+            # created_at is auto_now_add, backdate it to the original send
+            Campaign.objects.filter(id=campaign.id).update(created_at=created_at)
+            # A group is a contiguous run of legacy ids, so its id range picks
+            # exactly its rows without binding one parameter per row
+            EmailTrack.objects.filter(
+                campaign__isnull=True, id__gte=group[0][0], id__lte=group[-1][0]
+            ).update(campaign=campaign, subject="", message="")
@@ -0,0 +1,100 @@
+import socketserver
+import threading
+import time
+
+from django.core.mail import EmailMessage, send_mail
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from users.mail import PooledConnection
+
+SENDER = "bench@localhost"
+
+
+class StandInSMTPHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP dialogue that accepts and discards every message."""
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        # Stand in for the TLS + AUTH round trips a real provider costs
+        time.sleep(self.server.handshake_latency)
+        self.reply("220 localhost stand-in SMTP")
+        for raw in self.rfile:
+            command = raw.decode(errors="ignore").strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                self.reply("250 localhost")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                for data_line in self.rfile:
+                    if data_line in (b".\r\n", b".\n"):
+                        break
+                self.reply("250 OK queued")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class StandInSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handshake_latency=0.0):
+        super().__init__(("127.0.0.1", 0), StandInSMTPHandler)
+        self.handshake_latency = handshake_latency
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare per-message and pooled SMTP throughput against a local stand-in server"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=500)
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0.05,
+            help="Simulated connection handshake cost in seconds",
+        )
+        parser.add_argument("--max-messages", type=int, default=100)
+
+    def handle(self, *args, **options):
+        server = StandInSMTPServer(options["latency"])
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        count = options["messages"]
+
+        smtp_settings = {
+            "EMAIL_BACKEND": "django.core.mail.backends.smtp.EmailBackend",
+            "EMAIL_HOST": "127.0.0.1",
+            "EMAIL_PORT": server.server_address[1],
+            "EMAIL_USE_TLS": False,
+            "EMAIL_HOST_USER": "",
+            "EMAIL_HOST_PASSWORD": "",
+        }
+        try:
+            with override_settings(**smtp_settings):
+                # Before: one send_mail call (and connection) per recipient
+                start = time.perf_counter()
+                for i in range(count):
+                    send_mail("Bench", "Body", SENDER, [f"user{i}@gmail.com"])
+                before = count / (time.perf_counter() - start)
+
+                # After: one pooled connection recycled every --max-messages
+                connection = PooledConnection(max_messages=options["max_messages"])
+                start = time.perf_counter()
+                for i in range(count):
+                    connection.send(
+                        EmailMessage("Bench", "Body", SENDER, [f"user{i}@gmail.com"])
+                    )
+                connection.close()
+                after = count / (time.perf_counter() - start)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.stdout.write(f"send_mail per recipient: {before:.1f} messages/sec")
+        self.stdout.write(f"pooled connection:       {after:.1f} messages/sec")
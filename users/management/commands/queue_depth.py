@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from users.queues import queue_depths
+
+
+class Command(BaseCommand):
+    help = "Show how many messages are waiting on each Celery queue"
+
+    def handle(self, *args, **options):
+        for name, depth in queue_depths().items():
+            self.stdout.write(f"{name:<15} {depth}")
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from users.counters import rebuild_counters
+
+
+class Command(BaseCommand):
+    help = "Rebuild the per-user and per-campaign delivery counters from EmailTrack"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--user-id",
+            type=int,
+            action="append",
+            dest="user_ids",
+            help="Only rebuild this user's counters (can be repeated)",
+        )
+
+    def handle(self, *args, **options):
+        counters = rebuild_counters(options["user_ids"])
+        self.stdout.write(f"Rebuilt counters, {counters} user status totals")
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from users.models import DeadLetter
+from users.tasks import replay_dead_letters
+
+
+class Command(BaseCommand):
+    help = "Queue dead-lettered recipients to be sent again"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--campaign",
+            action="append",
+            dest="campaign_ids",
+            help="Only replay this campaign's recipients (can be repeated)",
+        )
+        parser.add_argument(
+            "--user-id",
+            type=int,
+            action="append",
+            dest="user_ids",
+            help="Only replay this user's recipients (can be repeated)",
+        )
+
+    def handle(self, *args, **options):
+        letters = DeadLetter.objects.all()
+        if options["campaign_ids"]:
+            letters = letters.filter(campaign_id__in=options["campaign_ids"])
+        if options["user_ids"]:
+            letters = letters.filter(username_id__in=options["user_ids"])
+        queued = replay_dead_letters(letters)
+        self.stdout.write(f"Queued {queued} dead-lettered recipients")
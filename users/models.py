@@ -1,3 +1,6 @@
+import os
+import uuid
+
 from django.conf import settings
 from django.contrib.auth.models import (
     AbstractBaseUser,
@@ -5,6 +8,11 @@ from django.contrib.auth.models import (
     PermissionsMixin,
 )
 from django.db import models
+from django.db.models import F
+from django.db.models.functions import Lower
+
+from .caching import TEMPLATES, invalidate_user_cache
+from .rendering import invalidate_template
 
 
 class CustomUserManager(BaseUserManager):
@@ -48,16 +56,228 @@ class EmailTemplate(models.Model):
     def __str__(self):
         return f"Template by {self.username} at {self.created_at}"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Drop the compiled form so the next render picks up the edit
+        invalidate_template(self.pk)
+        invalidate_user_cache(TEMPLATES, self.username_id)
+
+    def delete(self, *args, **kwargs):
+        invalidate_template(self.pk)
+        invalidate_user_cache(TEMPLATES, self.username_id)
+        return super().delete(*args, **kwargs)
+
+
+class Campaign(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    username = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    subject = models.CharField(max_length=255)
+    # Message text, or the template text for personalised sends
+    body = models.TextField()
+    template = models.ForeignKey(
+        EmailTemplate, null=True, blank=True, on_delete=models.SET_NULL
+    )
+    total_recipients = models.PositiveIntegerField(default=0)
+    sent_count = models.PositiveIntegerField(default=0)
+    failed_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Campaign '{self.subject}' by {self.username} at {self.created_at}"
+
 
 class EmailTrack(models.Model):
+    # queued -> sending -> sent / failed / deferred (deferred goes back to
+    # sending on retry). success and fail are from before delivery tracking.
+    STATUS_CHOICES = [
+        ("queued", "Queued"),
+        ("sending", "Sending"),
+        ("sent", "Sent"),
+        ("failed", "Failed"),
+        ("deferred", "Deferred"),
+        ("success", "Success"),
+        ("fail", "Fail"),
+    ]
+    # Statuses reported together on the dashboard
+    STATUS_GROUPS = {
+        "success": ["sent", "success"],
+        "fail": ["failed", "fail"],
+        "pending": ["queued", "sending", "deferred"],
+    }
+
     username = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
-    recipient = models.EmailField()
-    status = models.CharField(
-        max_length=10, choices=[("success", "Success"), ("fail", "Fail")]
+    campaign = models.ForeignKey(
+        Campaign, null=True, blank=True, on_delete=models.CASCADE
     )
+    recipient = models.EmailField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES)
     email_sent_date = models.DateTimeField(auto_now_add=True)
-    subject = models.CharField(max_length=255)
-    message = models.TextField()
+    # Legacy copies from before campaigns, emptied by backfill_campaigns.
+    # message also holds AI-personalised bodies, which can't be re-rendered.
+    subject = models.CharField(max_length=255, blank=True, default="")
+    message = models.TextField(blank=True, default="")
+    # Last SMTP reply, or the validation error for rejected addresses
+    smtp_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    smtp_response = models.CharField(max_length=255, blank=True, default="")
+    status_updated_at = models.DateTimeField(null=True, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Backs the per-status counts and newest-first listings on the dashboard
+            models.Index(
+                fields=["username", "status", "email_sent_date"],
+                name="emailtrack_user_status_date",
+            ),
+            # Backs the per-recipient frequency cap, whatever the address's case
+            models.Index(
+                F("username"),
+                Lower("recipient"),
+                F("email_sent_date"),
+                name="emailtrack_user_recipient_date",
+            ),
+        ]
 
     def __str__(self):
         return f"Email to {self.recipient} by {self.username} at {self.email_sent_date}"
+
+
+class RecipientUpload(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    username = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    file_name = models.CharField(max_length=255)
+    spool_path = models.CharField(max_length=500)
+    columns = models.JSONField(default=list)
+    total_rows = models.PositiveIntegerField(default=0)
+    valid_rows = models.PositiveIntegerField(default=0)
+    invalid_rows = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Upload {self.file_name} by {self.username} at {self.created_at}"
+
+    def delete(self, *args, **kwargs):
+        # Remove the spooled rows along with the record
+        if os.path.exists(self.spool_path):
+            os.remove(self.spool_path)
+        return super().delete(*args, **kwargs)
+
+
+class DeliveryCounter(models.Model):
+    # Running EmailTrack totals per status, for the user as a whole
+    # (campaign empty) and per campaign. Rebuilt by rebuild_counters.
+    username = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    campaign = models.ForeignKey(
+        Campaign, null=True, blank=True, on_delete=models.CASCADE
+    )
+    status = models.CharField(max_length=10, choices=EmailTrack.STATUS_CHOICES)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["username", "status"],
+                condition=models.Q(campaign__isnull=True),
+                name="deliverycounter_user_status",
+            ),
+            models.UniqueConstraint(
+                fields=["campaign", "status"],
+                condition=models.Q(campaign__isnull=False),
+                name="deliverycounter_campaign_status",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.count} {self.status} for {self.username} ({self.campaign_id})"
+
+
+class DailyDeliveryTotal(models.Model):
+    # EmailTrack rows per day and status that were moved to the archive by
+    # archive_email_tracks, so historical totals survive without the rows
+    username = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    campaign = models.ForeignKey(
+        Campaign, null=True, blank=True, on_delete=models.CASCADE
+    )
+    day = models.DateField()
+    status = models.CharField(max_length=10, choices=EmailTrack.STATUS_CHOICES)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["username", "day", "status"],
+                condition=models.Q(campaign__isnull=True),
+                name="dailydeliverytotal_user_day_status",
+            ),
+            models.UniqueConstraint(
+                fields=["campaign", "day", "status"],
+                condition=models.Q(campaign__isnull=False),
+                name="dailydeliverytotal_campaign_day_status",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.count} {self.status} on {self.day} for {self.username}"
+
+
+class DeadLetter(models.Model):
+    # A recipient that still failed after every retry, kept so it can be
+    # sent again with replay_dead_letters
+    username = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    campaign = models.ForeignKey(Campaign, on_delete=models.CASCADE)
+    track = models.ForeignKey(EmailTrack, on_delete=models.CASCADE)
+    recipient = models.EmailField()
+    # The personalised body that was being sent; empty for the campaign body
+    body = models.TextField(blank=True, default="")
+    smtp_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    smtp_response = models.CharField(max_length=255, blank=True, default="")
+    attempts = models.PositiveSmallIntegerField(default=1)
+    created_at = models.DateTimeField(auto_now_add=True)
+    replayed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Dead letter to {self.recipient} ({self.campaign_id})"
+
+
+class Suppression(models.Model):
+    # Addresses a user's sends skip, stored lower-cased and trimmed
+    REASON_CHOICES = [
+        ("bounce", "Hard bounce"),
+        ("unsubscribe", "Unsubscribed"),
+        ("complaint", "Complaint"),
+        ("manual", "Added manually"),
+    ]
+
+    username = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    email = models.EmailField()
+    reason = models.CharField(max_length=12, choices=REASON_CHOICES, default="manual")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["username", "email"], name="suppression_user_email"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.email} suppressed for {self.username} ({self.reason})"
+
+
+class AIJob(models.Model):
+    # A Celery task id a user may poll through AIJobStatusView. A suggestion
+    # job joined by several users (same prompt) gets a row for each of them.
+    job_id = models.CharField(max_length=36)
+    username = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["job_id", "username"], name="aijob_job_user"
+            ),
+        ]
+
+    def __str__(self):
+        return f"AI job {self.job_id} for {self.username}"
@@ -0,0 +1,12 @@
+from celery import current_app
+from django.conf import settings
+
+
+def queue_depths():
+    # Messages waiting on each queue; ones a worker has already taken aren't counted
+    with current_app.connection_for_read() as connection:
+        channel = connection.default_channel
+        return {
+            queue.name: channel.queue_declare(queue=queue.name).message_count
+            for queue in settings.CELERY_TASK_QUEUES
+        }
@@ -0,0 +1,139 @@
+import logging
+import threading
+import time
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Refills and takes one token from every bucket in KEYS atomically, or takes
+# nothing and returns how long to wait until all of them have a token.
+# ARGV = now, ttl, then (rate, capacity) per key.
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local ttl = tonumber(ARGV[2])
+local wait = 0
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2 + 1])
+    local capacity = tonumber(ARGV[i * 2 + 2])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    levels[i] = tokens
+    if tokens < 1 then
+        wait = math.max(wait, (1 - tokens) / rate)
+    end
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+    redis.call('HMSET', key, 'tokens', tostring(levels[i] - 1), 'ts', tostring(now))
+    redis.call('EXPIRE', key, ttl)
+end
+return '0'
+"""
+
+
+class LocalBuckets:
+    """In-process token buckets, used when Redis is not reachable."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.levels = {}
+
+    def take(self, buckets, now):
+        with self.lock:
+            wait = 0
+            levels = []
+            for key, rate, capacity in buckets:
+                tokens, ts = self.levels.get(key, (capacity, now))
+                tokens = min(capacity, tokens + max(0, now - ts) * rate)
+                levels.append(tokens)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+            if wait > 0:
+                return wait
+            for (key, _, _), tokens in zip(buckets, levels):
+                self.levels[key] = (tokens - 1, now)
+            return 0
+
+
+class RedisBuckets:
+    """Token buckets shared by every worker through Redis."""
+
+    def __init__(self, client, ttl=3600):
+        self.script = client.register_script(TOKEN_BUCKET_SCRIPT)
+        self.ttl = ttl
+
+    def take(self, buckets, now):
+        keys = [key for key, _, _ in buckets]
+        args = [now, self.ttl]
+        for _, rate, capacity in buckets:
+            args.extend([rate, capacity])
+        return float(self.script(keys=keys, args=args))
+
+
+class RateLimiter:
+    """Per-sender and per-recipient-domain token bucket rate limiter.
+
+    ``limits`` follows the ``EMAIL_RATE_LIMITS`` setting: a ``sender`` limit
+    and a ``domains`` mapping, each given as ``per_minute`` and ``burst``.
+    Domains without an entry are only limited by the sender bucket.
+    """
+
+    def __init__(self, limits=None, backend=None, clock=time.time, sleep=time.sleep):
+        self.limits = limits if limits is not None else settings.EMAIL_RATE_LIMITS
+        self.backend = backend or LocalBuckets()
+        self.fallback = LocalBuckets()
+        self.clock = clock
+        self.sleep = sleep
+
+    def buckets_for(self, sender, recipient):
+        buckets = []
+        sender_limit = self.limits.get("sender")
+        if sender_limit:
+            buckets.append((f"ratelimit:sender:{sender}", *self._rate(sender_limit)))
+
+        domain = recipient.rsplit("@", 1)[-1].lower()
+        domain_limit = self.limits.get("domains", {}).get(domain)
+        if domain_limit:
+            buckets.append((f"ratelimit:domain:{domain}", *self._rate(domain_limit)))
+        return buckets
+
+    def _rate(self, limit):
+        return limit["per_minute"] / 60.0, limit.get("burst", 1)
+
+    def try_acquire(self, sender, recipient):
+        # Returns 0 when a token was taken, otherwise the seconds to wait
+        buckets = self.buckets_for(sender, recipient)
+        if not buckets:
+            return 0
+        try:
+            return self.backend.take(buckets, self.clock())
+        except redis.RedisError as e:
+            logger.warning(f"Rate limiter backend unavailable, limiting locally: {e}")
+            return self.fallback.take(buckets, self.clock())
+
+    def acquire(self, sender, recipient):
+        while True:
+            wait = self.try_acquire(sender, recipient)
+            if not wait:
+                return
+            logger.info(f"Rate limit reached for {recipient}, waiting {wait:.2f}s")
+            self.sleep(wait)
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter():
+    global _rate_limiter
+    if _rate_limiter is None:
+        url = settings.EMAIL_RATE_LIMIT_REDIS_URL
+        backend = RedisBuckets(redis.Redis.from_url(url)) if url else None
+        _rate_limiter = RateLimiter(backend=backend)
+    return _rate_limiter
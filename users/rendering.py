@@ -0,0 +1,84 @@
+import html
+import re
+from collections import OrderedDict
+from functools import lru_cache
+
+# {{ and }} are literal braces, {column} or {column|default} is a field
+PLACEHOLDER_RE = re.compile(r"\{\{|\}\}|\{(\w+)(?:\|([^{}]*))?\}")
+
+# Compiled EmailTemplates kept per template id
+TEMPLATE_CACHE_SIZE = 256
+
+
+class CompiledTemplate:
+    """A template parsed once into literal parts and field slots.
+
+    Rendering copies the parts, fills each field slot from the row and joins
+    the result, so the template text is never scanned again per recipient.
+    """
+
+    __slots__ = ("parts", "fields")
+
+    def __init__(self, parts, fields):
+        self.parts = parts
+        # (index into parts, column name, default, placeholder) per field
+        self.fields = fields
+
+    def render(self, row, escape=False):
+        parts = self.parts.copy()
+        for index, name, default, placeholder in self.fields:
+            value = row.get(name)
+            if value is None:
+                # Without a default, a missing column leaves the placeholder as is
+                value = placeholder if default is None else default
+            elif value == "" and default is not None:
+                value = default
+            value = str(value)
+            parts[index] = html.escape(value) if escape else value
+        return "".join(parts)
+
+
+def parse_template(text):
+    parts = []
+    fields = []
+    literal = ""
+    position = 0
+    for match in PLACEHOLDER_RE.finditer(text):
+        literal += text[position : match.start()]
+        token = match.group(0)
+        if token in ("{{", "}}"):
+            literal += token[0]
+        else:
+            parts.append(literal)
+            literal = ""
+            fields.append((len(parts), match.group(1), match.group(2), token))
+            parts.append("")
+        position = match.end()
+    parts.append(literal + text[position:])
+    return CompiledTemplate(parts, fields)
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_template(text):
+    return parse_template(text)
+
+
+_template_cache = OrderedDict()
+
+
+def get_compiled_template(template):
+    # Cached per EmailTemplate id; the stored text guards against stale entries
+    cached = _template_cache.get(template.id)
+    if cached is not None and cached[0] == template.created_template:
+        _template_cache.move_to_end(template.id)
+        return cached[1]
+
+    compiled = parse_template(template.created_template)
+    _template_cache[template.id] = (template.created_template, compiled)
+    if len(_template_cache) > TEMPLATE_CACHE_SIZE:
+        _template_cache.popitem(last=False)
+    return compiled
+
+
+def invalidate_template(template_id):
+    _template_cache.pop(template_id, None)
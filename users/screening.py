@@ -0,0 +1,90 @@
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db.models import Count
+from django.db.models.functions import Lower
+from django.utils import timezone
+
+from .models import EmailTrack
+from .suppression import SUPPRESSED_REASON, get_suppression_list, normalise_addresses
+from .validators import check_email_addresses
+
+DUPLICATE_REASON = "Duplicate recipient in this send."
+# Statuses that don't count towards the frequency cap, nothing was delivered
+UNDELIVERED_STATUSES = ["failed", "fail"]
+
+
+def recent_send_counts(user_id, addresses, since):
+    """Count the user's sends to each normalised address since ``since``.
+
+    Each batch is one query on the (username, lower(recipient),
+    email_sent_date) index, so the cost follows the addresses asked about,
+    not the size of the tracking history.
+    """
+    counts = {}
+    for i in range(0, len(addresses), 500):
+        rows = (
+            EmailTrack.objects.filter(username_id=user_id, email_sent_date__gte=since)
+            .exclude(status__in=UNDELIVERED_STATUSES)
+            .annotate(address=Lower("recipient"))
+            .filter(address__in=addresses[i : i + 500])
+            .values_list("address")
+            .annotate(sends=Count("id"))
+            .order_by()
+        )
+        counts.update(rows)
+    return counts
+
+
+def over_frequency_cap(user_id, emails, cap=None):
+    # Boolean array, True where the address already had its share of mail
+    cap = settings.EMAIL_FREQUENCY_CAP if cap is None else cap
+    if not cap:
+        return np.zeros(len(emails), dtype=bool)
+    codes, uniques = pd.factorize(normalise_addresses(emails))
+    since = timezone.now() - timedelta(hours=settings.EMAIL_FREQUENCY_WINDOW_HOURS)
+    counts = recent_send_counts(user_id, uniques.tolist(), since)
+    sends = uniques.map(lambda address: counts.get(address, 0))
+    return np.asarray(sends >= cap, dtype=bool)[codes]
+
+
+def screen_recipients(user_id, emails):
+    """Why each valid address should not be sent to, "" for the ones to send.
+
+    Repeats of an address within the send (ignoring case and spaces), then
+    suppressed addresses, then ones at the frequency cap, each checked in
+    one pass over the remaining addresses.
+    """
+    addresses = normalise_addresses(emails)
+    reasons = np.full(len(addresses), "", dtype=object)
+    reasons[addresses.duplicated().to_numpy()] = DUPLICATE_REASON
+
+    pending = reasons == ""
+    suppressed = get_suppression_list().suppressed(user_id, addresses[pending])
+    reasons[np.flatnonzero(pending)[suppressed]] = SUPPRESSED_REASON
+
+    pending = reasons == ""
+    capped = over_frequency_cap(user_id, addresses[pending])
+    reasons[np.flatnonzero(pending)[capped]] = (
+        f"Recipient already received {settings.EMAIL_FREQUENCY_CAP} emails in the "
+        f"last {settings.EMAIL_FREQUENCY_WINDOW_HOURS} hours."
+    )
+    return reasons
+
+
+def check_recipients(user_id, emails):
+    """Validate and screen the recipients of one send.
+
+    Returns a boolean array marking the addresses to send to, and the rest
+    as ``{"email", "reason"}`` records in their original order.
+    """
+    checked = check_email_addresses(emails)
+    valid = (checked["reason"] == "").to_numpy()
+    checked.loc[valid, "reason"] = screen_recipients(
+        user_id, checked.loc[valid, "email"]
+    )
+    valid = (checked["reason"] == "").to_numpy()
+    invalid = checked.loc[~valid, ["email", "reason"]].to_dict(orient="records")
+    return valid, invalid
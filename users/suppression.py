@@ -0,0 +1,131 @@
+import logging
+
+import numpy as np
+import pandas as pd
+import redis
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Suppression
+
+logger = logging.getLogger(__name__)
+
+SUPPRESSED_REASON = "Address is on the suppression list."
+# Permanent replies that mean the mailbox doesn't exist or won't accept mail
+HARD_BOUNCE_CODES = {550, 551, 553}
+# Member marking a user's set as loaded, so an empty list is cached too
+LOADED = ""
+
+
+def normalise_addresses(emails):
+    # "  Ann@Gmail.com" and "ann@gmail.com" are the same recipient
+    return pd.Series(emails, dtype=object).astype(str).str.strip().str.lower()
+
+
+class SuppressionList:
+    """Redis set cache of each user's suppressed addresses.
+
+    The Suppression table is the source of truth. A user's set is loaded
+    from it on first use and dropped whenever the table changes, so each
+    check is one SMISMEMBER for all the distinct addresses of a send.
+    """
+
+    def __init__(self, client, ttl=None):
+        self.client = client
+        self.ttl = ttl or settings.SUPPRESSION_CACHE_TTL
+
+    def set_key(self, user_id):
+        return f"suppressed:{user_id}"
+
+    def suppressed(self, user_id, emails):
+        # Boolean array, True where the address at that position is suppressed
+        codes, uniques = pd.factorize(normalise_addresses(emails))
+        found = self.lookup(user_id, uniques.tolist())
+        return np.asarray(uniques.isin(found), dtype=bool)[codes]
+
+    def lookup(self, user_id, addresses):
+        if not addresses:
+            return set()
+        key = self.set_key(user_id)
+        try:
+            if not self.client.exists(key):
+                self.load(user_id)
+            hits = self.client.smismember(key, addresses)
+        except redis.RedisError as e:
+            logger.warning(f"Suppression cache unavailable, using database: {e}")
+            return self.lookup_database(user_id, addresses)
+        return {address for address, hit in zip(addresses, hits) if hit}
+
+    def lookup_database(self, user_id, addresses):
+        found = set()
+        for i in range(0, len(addresses), 1000):
+            found.update(
+                Suppression.objects.filter(
+                    username_id=user_id, email__in=addresses[i : i + 1000]
+                ).values_list("email", flat=True)
+            )
+        return found
+
+    def load(self, user_id):
+        key = self.set_key(user_id)
+        emails = Suppression.objects.filter(username_id=user_id).values_list(
+            "email", flat=True
+        )
+        with self.client.pipeline() as pipe:
+            pipe.delete(key)
+            pipe.sadd(key, LOADED)
+            batch = []
+            for email in emails.iterator(chunk_size=5000):
+                batch.append(email)
+                if len(batch) == 5000:
+                    pipe.sadd(key, *batch)
+                    batch = []
+            if batch:
+                pipe.sadd(key, *batch)
+            pipe.expire(key, self.ttl)
+            pipe.execute()
+
+    def invalidate(self, user_id):
+        try:
+            self.client.delete(self.set_key(user_id))
+        except redis.RedisError as e:
+            # The TTL will drop the stale set
+            logger.warning(f"Suppression cache unavailable, not invalidated: {e}")
+
+
+_suppression_list = None
+
+
+def get_suppression_list():
+    global _suppression_list
+    if _suppression_list is None:
+        _suppression_list = SuppressionList(
+            redis.Redis.from_url(settings.SUPPRESSION_REDIS_URL)
+        )
+    return _suppression_list
+
+
+def add_suppressions(user_id, emails, reason):
+    # Returns how many addresses were new to the list
+    addresses = normalise_addresses(emails)
+    addresses = addresses[addresses != ""].drop_duplicates().tolist()
+    existing = Suppression.objects.filter(username_id=user_id)
+    before = existing.count()
+    Suppression.objects.bulk_create(
+        [
+            Suppression(username_id=user_id, email=email, reason=reason)
+            for email in addresses
+        ],
+        batch_size=settings.EMAIL_TRACK_BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+    get_suppression_list().invalidate(user_id)
+    return existing.count() - before
+
+
+@receiver(post_save, sender=Suppression)
+@receiver(post_delete, sender=Suppression)
+def suppression_changed(sender, instance, **kwargs):
+    # Single edits, e.g. from the admin; bulk imports invalidate themselves
+    get_suppression_list().invalidate(instance.username_id)
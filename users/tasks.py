@@ -1,35 +1,513 @@
 import logging
-from time import sleep
+import random
+import time
+import uuid
+from collections import defaultdict
+from itertools import repeat
+from smtplib import (
+    SMTPConnectError,
+    SMTPException,
+    SMTPRecipientsRefused,
+    SMTPServerDisconnected,
+)
 
-from celery import shared_task
+from celery import chord, shared_task
 from django.conf import settings
-from django.core.mail import send_mail
+from django.core.cache import cache
+from django.core.mail import EmailMessage
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef
+from django.utils import timezone
+
+from .ai import generate_suggestions, normalise_description, personalise_openers, run
+from .archive import archive_cutoff, archive_email_tracks
+from .counters import campaign_owner, record_status_changes
+from .ledger import get_send_ledger
+from .mail import get_pooled_connection
+from .models import (
+    Campaign,
+    DeadLetter,
+    DeliveryCounter,
+    EmailTemplate,
+    EmailTrack,
+    RecipientUpload,
+)
+from .ratelimit import get_rate_limiter
+from .rendering import compile_template, get_compiled_template
+from .screening import screen_recipients
+from .suppression import HARD_BOUNCE_CODES, add_suppressions
+from .tracking import (
+    StatusBuffer,
+    claim_tracks,
+    dead_letter,
+    is_transient_reply,
+    mark_tracks,
+    smtp_error_details,
+)
+from .uploads import read_recipient_csv
 
 logger = logging.getLogger(__name__)
 
+# Errors that mean the SMTP server or network went away, not that one
+# recipient was refused, so the rest of the chunk is worth retrying
+TRANSIENT_ERRORS = (
+    SMTPServerDisconnected,
+    SMTPConnectError,
+    ConnectionError,
+    TimeoutError,
+)
 
-@shared_task
-def send_email_task(subject, message, valid_emails):
+# Reported on tracking rows whose send never reached the broker
+DISPATCH_FAILED_REASON = "Could not be queued for sending."
+
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def dispatch_campaign(
+    campaign_id, subject, message, recipients, bodies=None, chunk_size=None
+):
+    # Fan the recipients out over all workers, one subtask per chunk.
+    # recipients holds [track_id, email] pairs; bodies, when given, holds
+    # each recipient's personalised message.
+    chunk_size = chunk_size or settings.EMAIL_CHUNK_SIZE
+    body_chunks = chunked(bodies, chunk_size) if bodies else repeat(None)
+    # Small sends skip ahead of any campaign waiting on the bulk queue
+    if len(recipients) <= settings.EMAIL_TRANSACTIONAL_MAX_RECIPIENTS:
+        options = {"queue": "transactional", "priority": 0}
+    else:
+        options = {"queue": "bulk"}
+    header = [
+        send_email_task.s(campaign_id, subject, message, chunk, chunk_bodies).set(
+            **options
+        )
+        for chunk, chunk_bodies in zip(chunked(recipients, chunk_size), body_chunks)
+    ]
+    if header:
+        chord(header)(finalize_campaign.s(campaign_id).set(**options))
+        logger.info(
+            f"Campaign {campaign_id}: {len(recipients)} recipients "
+            f"in {len(header)} chunks on the {options['queue']} queue"
+        )
+
+
+def start_campaign(
+    user,
+    subject,
+    body,
+    valid_emails,
+    invalid,
+    bodies=None,
+    template=None,
+    keep_bodies=False,
+):
+    # invalid holds {"email", "reason"} records from check_recipients.
+    # keep_bodies stores each personalised body on its tracking row, for
+    # bodies that can't be rendered again later (AI output).
+    now = timezone.now()
+    with transaction.atomic():
+        campaign = Campaign.objects.create(
+            username=user,
+            subject=subject,
+            body=body,
+            template=template,
+            total_recipients=len(valid_emails) + len(invalid),
+            failed_count=len(invalid),
+            # Every recipient rejected: no chunk will ever report back
+            finished_at=None if valid_emails else now,
+        )
+        queued = [
+            EmailTrack(
+                username=user,
+                campaign=campaign,
+                recipient=email,
+                status="queued",
+                status_updated_at=now,
+                message=bodies[i] if keep_bodies else "",
+            )
+            for i, email in enumerate(valid_emails)
+        ]
+        rejected = [
+            EmailTrack(
+                username=user,
+                campaign=campaign,
+                recipient=item["email"],
+                status="failed",
+                smtp_response=item["reason"],
+                status_updated_at=now,
+            )
+            for item in invalid
+        ]
+        # Batched INSERTs committed once instead of one autocommit per recipient
+        EmailTrack.objects.bulk_create(
+            queued + rejected, batch_size=settings.EMAIL_TRACK_BATCH_SIZE
+        )
+        record_status_changes(
+            campaign.id, {"queued": len(queued), "failed": len(rejected)}, user.id
+        )
+
+    # Enqueue only once the campaign and its tracking rows are committed.
+    # The worker reports each recipient's outcome against its track id.
+    recipients = [[track.id, track.recipient] for track in queued]
     try:
-        for email in valid_emails:
+        dispatch_campaign(str(campaign.id), subject, body, recipients, bodies)
+    except Exception:
+        # Nothing will send the rows that are still queued, so fail them
+        # rather than leave them pending forever
+        logger.exception(f"Campaign {campaign.id}: could not enqueue the send")
+        with transaction.atomic():
+            undispatched = EmailTrack.objects.filter(
+                campaign=campaign, status="queued"
+            ).update(
+                status="failed",
+                smtp_response=DISPATCH_FAILED_REASON,
+                status_updated_at=timezone.now(),
+            )
+            record_status_changes(
+                campaign.id, {"queued": -undispatched, "failed": undispatched}, user.id
+            )
+            Campaign.objects.filter(id=campaign.id).update(
+                failed_count=F("failed_count") + undispatched,
+                finished_at=timezone.now(),
+            )
+        raise
+    return campaign
+
+
+def backoff_delay(attempt):
+    # Exponential backoff with jitter, so deferred recipients don't all come
+    # back to the server at the same moment
+    delay = min(
+        settings.EMAIL_RETRY_MAX_DELAY, settings.EMAIL_RETRY_BASE_DELAY * 2**attempt
+    )
+    return random.uniform(delay / 2, delay)
+
+
+def add_campaign_totals(campaign_id, totals):
+    Campaign.objects.filter(id=campaign_id).update(
+        sent_count=F("sent_count") + totals["sent"],
+        failed_count=F("failed_count") + totals["failed"],
+    )
+    # Called by the chord callback and by every deferred retry; whichever
+    # leaves nothing queued, sending or deferred finishes the campaign
+    unfinished = DeliveryCounter.objects.filter(
+        campaign=OuterRef("pk"),
+        status__in=EmailTrack.STATUS_GROUPS["pending"],
+        count__gt=0,
+    )
+    Campaign.objects.filter(id=campaign_id, finished_at__isnull=True).exclude(
+        Exists(unfinished)
+    ).update(finished_at=timezone.now())
+
+
+@shared_task(
+    bind=True,
+    max_retries=3,
+    # Acknowledge only once the chunk is done, so a chunk whose worker died
+    # is redelivered and resumes from its checkpoints
+    acks_late=True,
+    reject_on_worker_lost=True,
+)
+def send_email_task(
+    self,
+    campaign_id,
+    subject,
+    message,
+    recipients,
+    bodies=None,
+    start=0,
+    failed=0,
+    deferred=0,
+    attempt=0,
+):
+    # attempt counts the earlier tries of recipients deferred by a 4xx reply.
+    # Those retries run outside the campaign's chord and add their own totals.
+    connection = get_pooled_connection()
+    rate_limiter = get_rate_limiter()
+    ledger = get_send_ledger()
+    statuses = StatusBuffer(campaign_id)
+    position = start
+    retry_later = []
+    exhausted = []
+    bounced = []
+    # Checkpoints: final states already flushed to the tracking rows, and
+    # sends recorded in the ledger but not flushed before a crash
+    finished = claim_tracks(
+        [track_id for track_id, _ in recipients[start:]], campaign_id
+    )
+    delivered = ledger.sent(campaign_id, [email for _, email in recipients[start:]])
+
+    def hand_off():
+        # Schedule the deferred recipients as a task of their own and store
+        # the ones out of attempts, once their statuses are written
+        nonlocal retry_later, exhausted, bounced
+        statuses.flush()
+        dead_letter(campaign_id, exhausted, attempt + 1)
+        if bounced:
+            # Hard bounces won't be mailed again by this user's later sends
+            add_suppressions(campaign_owner(campaign_id), bounced, "bounce")
+        if retry_later:
+            send_email_task.apply_async(
+                (
+                    campaign_id,
+                    subject,
+                    message,
+                    [recipients[i] for i in retry_later],
+                    [bodies[i] for i in retry_later] if bodies else None,
+                ),
+                {"attempt": attempt + 1},
+                countdown=backoff_delay(attempt),
+                queue=(self.request.delivery_info or {}).get("routing_key"),
+            )
+        retry_later, exhausted, bounced = [], [], []
+
+    try:
+        for i, (track_id, email) in enumerate(recipients[start:], start):
+            if track_id in finished:
+                failed += finished[track_id] in ("failed", "fail")
+                position += 1
+                continue
+            if email in delivered:
+                statuses.add(track_id, "sent", None, "Sent before the task restarted")
+                position += 1
+                continue
+
+            # Wait only if the sender or recipient domain quota is used up
+            rate_limiter.acquire(settings.EMAIL_HOST_USER, email)
             logger.info(f"Sending email to {email}")
 
-            # Send the email
-            send_mail(
-                subject,
-                message,
-                settings.EMAIL_HOST_USER,  # Sender email
-                [email],  # Recipient email
-                fail_silently=False,  # Fail if there's an error
+            try:
+                # Send the email over the worker's pooled SMTP connection
+                connection.send(
+                    EmailMessage(
+                        subject,
+                        bodies[i] if bodies else message,
+                        settings.EMAIL_HOST_USER,  # Sender email
+                        [email],  # Recipient email
+                    )
+                )
+                ledger.record(campaign_id, email)
+                statuses.add(track_id, "sent", 250)
+                logger.info(f"Email sent to {email}")
+            except TRANSIENT_ERRORS:
+                raise
+            except SMTPException as e:
+                # One refused recipient should not stop the rest of the chunk
+                code, response = smtp_error_details(e)
+                if not is_transient_reply(code):
+                    logger.error(f"Error sending email to {email}: {str(e)}")
+                    statuses.add(track_id, "failed", code, response)
+                    failed += 1
+                    if (
+                        isinstance(e, SMTPRecipientsRefused)
+                        and code in HARD_BOUNCE_CODES
+                    ):
+                        bounced.append(email)
+                elif attempt + 1 < settings.EMAIL_RECIPIENT_MAX_ATTEMPTS:
+                    logger.warning(f"Deferring email to {email}: {str(e)}")
+                    statuses.add(track_id, "deferred", code, response)
+                    retry_later.append(i)
+                    deferred += 1
+                else:
+                    logger.error(f"Giving up on email to {email}: {str(e)}")
+                    statuses.add(track_id, "failed", code, response)
+                    body = bodies[i] if bodies else ""
+                    exhausted.append((track_id, email, body, code, response))
+                    failed += 1
+            position += 1
+
+    except TRANSIENT_ERRORS as e:
+        # Don't hand a connection in an unknown state to the next task
+        connection.close()
+        hand_off()
+        remaining = recipients[position:]
+        remaining_ids = [track_id for track_id, _ in remaining]
+        if self.request.retries < self.max_retries:
+            logger.warning(
+                f"Error sending email, retrying {len(remaining)} recipients: {str(e)}"
+            )
+            mark_tracks(remaining_ids, "deferred", str(e), campaign_id)
+            raise self.retry(
+                exc=e,
+                countdown=backoff_delay(self.request.retries),
+                kwargs={
+                    "start": position,
+                    "failed": failed,
+                    "deferred": deferred,
+                    "attempt": attempt,
+                },
+            )
+
+        logger.error(f"Giving up on {len(remaining)} recipients: {str(e)}")
+        mark_tracks(remaining_ids, "failed", str(e), campaign_id)
+        dead_letter(
+            campaign_id,
+            [
+                (track_id, email, bodies[i] if bodies else "", None, str(e))
+                for i, (track_id, email) in enumerate(remaining, position)
+            ],
+            self.request.retries + 1,
+        )
+        failed += len(remaining)
+        position = len(recipients)
+    finally:
+        hand_off()
+
+    totals = {"sent": position - failed - deferred, "failed": failed}
+    if attempt:
+        add_campaign_totals(campaign_id, totals)
+    return totals
+
+
+@shared_task
+def finalize_campaign(results, campaign_id):
+    totals = {
+        "sent": sum(result["sent"] for result in results),
+        "failed": sum(result["failed"] for result in results),
+    }
+    add_campaign_totals(campaign_id, totals)
+    logger.info(
+        f"Campaign {campaign_id} chunks done: {totals['sent']} sent, "
+        f"{totals['failed']} failed"
+    )
+    return totals
+
+
+def replay_dead_letters(letters):
+    """Send dead-lettered recipients again, one dispatch per campaign.
+
+    Their tracking rows go back to queued and the campaign's failed count
+    drops by the same number. Returns how many recipients were queued.
+    """
+    by_campaign = defaultdict(list)
+    for letter in letters.filter(replayed_at__isnull=True).select_related("campaign"):
+        by_campaign[letter.campaign].append(letter)
+
+    for campaign, batch in by_campaign.items():
+        with transaction.atomic():
+            mark_tracks(
+                [letter.track_id for letter in batch], "queued", campaign_id=campaign.id
+            )
+            # Unfinished again until the replayed recipients are done
+            Campaign.objects.filter(id=campaign.id).update(
+                failed_count=F("failed_count") - len(batch), finished_at=None
             )
+            DeadLetter.objects.filter(id__in=[letter.id for letter in batch]).update(
+                replayed_at=timezone.now()
+            )
+        bodies = None
+        if any(letter.body for letter in batch):
+            bodies = [letter.body or campaign.body for letter in batch]
+        dispatch_campaign(
+            str(campaign.id),
+            campaign.subject,
+            campaign.body,
+            [[letter.track_id, letter.recipient] for letter in batch],
+            bodies,
+        )
+    return sum(len(batch) for batch in by_campaign.values())
+
+
+def suggestion_job_key(description, model):
+    return f"ai-job:{model}:{normalise_description(description)}"
 
-            logger.info(f"Email sent to {email}")
 
-            # Introduce a delay between sending each email
-            logger.info("Waiting for 2 seconds before sending next email...")
-            sleep(2)
-            logger.info("Resuming email sending...")
+def queue_suggestions(description, model=None):
+    # Queue a generation on the ai queue and return its job id. A prompt
+    # that is already being generated joins the job in flight.
+    model = model or settings.OLLAMA_MODEL
+    key = suggestion_job_key(description, model)
+    job_id = str(uuid.uuid4())
+    if not cache.add(key, job_id, settings.AI_JOB_TIMEOUT):
+        existing = cache.get(key)
+        if existing:
+            return existing
+        cache.set(key, job_id, settings.AI_JOB_TIMEOUT)
 
-    except Exception as e:
-        logger.error(f"Error sending email: {str(e)}")
-        return f"Failed to send email: {str(e)}"
+    try:
+        generate_suggestions_task.apply_async(args=(description, model), task_id=job_id)
+    except Exception:
+        cache.delete(key)
+        raise
+    return job_id
+
+
+@shared_task(bind=True)
+def generate_suggestions_task(self, description, model=None):
+    try:
+        return run(generate_suggestions(description, model))
+    finally:
+        # Later requests for this prompt start a new job
+        key = suggestion_job_key(description, model or settings.OLLAMA_MODEL)
+        if cache.get(key) == self.request.id:
+            cache.delete(key)
+
+
+@shared_task
+def personalise_campaign_task(
+    user_id, upload_id, subject, description, message, template_id=None
+):
+    # Open every recipient's message with an AI-written line, then send the
+    # batch as one campaign with the personalised bodies
+    upload = RecipientUpload.objects.select_related("username").get(
+        id=upload_id, username_id=user_id
+    )
+    template = None
+    if template_id:
+        template = EmailTemplate.objects.get(id=template_id, username_id=user_id)
+        message = template.created_template
+        compiled = get_compiled_template(template)
+    else:
+        compiled = compile_template(message)
+    # The spool only holds rows that passed validation, but repeats, newly
+    # suppressed addresses and capped recipients are skipped before prompting
+    df = read_recipient_csv(upload.spool_path)
+    reasons = screen_recipients(user_id, df["email"])
+    skip = reasons != ""
+    invalid = [
+        {"email": email, "reason": reason}
+        for email, reason in zip(df.loc[skip, "email"], reasons[skip])
+    ]
+    rows = df[~skip].to_dict(orient="records")
+
+    started = time.perf_counter()
+    openers = run(personalise_openers(description, rows))
+    elapsed = time.perf_counter() - started
+
+    bodies = [
+        "\n\n".join(part for part in (opener, compiled.render(row)) if part)
+        for opener, row in zip(openers, rows)
+    ]
+    campaign = start_campaign(
+        upload.username,
+        subject,
+        message,
+        [row["email"] for row in rows],
+        invalid,
+        bodies,
+        template,
+        keep_bodies=True,
+    )
+
+    per_minute = len(rows) / elapsed * 60 if elapsed else 0.0
+    logger.info(
+        f"Campaign {campaign.id}: personalised {len(rows)} recipients "
+        f"at {per_minute:.1f} recipients/minute"
+    )
+    return {
+        "campaign_id": str(campaign.id),
+        "recipients": len(rows),
+        "personalised": sum(1 for opener in openers if opener),
+        "seconds": round(elapsed, 2),
+        "recipients_per_minute": round(per_minute, 1),
+    }
+
+
+@shared_task
+def archive_email_tracks_task():
+    # Nightly on the maintenance queue, see CELERY_BEAT_SCHEDULE
+    archived = archive_email_tracks(archive_cutoff())
+    logger.info(f"Archived {archived} email tracking rows")
+    return archived
@@ -0,0 +1,1702 @@
+import asyncio
+import io
+import json
+import re
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from smtplib import SMTPRecipientsRefused, SMTPServerDisconnected
+from unittest import mock
+
+import dns.name
+import dns.resolver
+import pandas as pd
+import redis
+from celery.exceptions import Retry
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail import EmailMessage
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.management import call_command
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.test.utils import override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from .ai import (
+    SuggestionCache,
+    close_client,
+    generate_suggestions,
+    personalise_openers,
+    run,
+)
+from .archive import add_daily_totals, archive_email_tracks, write_archive
+from .caching import TEMPLATES, cached_response, invalidate_user_cache
+from .counters import (
+    increment_counter,
+    rebuild_counters,
+    record_status_changes,
+    user_status_counts,
+)
+from .deliverability import DeliverabilityChecker
+from .mail import PooledConnection
+from .models import (
+    Campaign,
+    CustomUser,
+    DeadLetter,
+    DeliveryCounter,
+    EmailTemplate,
+    EmailTrack,
+    RecipientUpload,
+    Suppression,
+)
+from .ratelimit import RateLimiter
+from .rendering import compile_template, get_compiled_template
+from .screening import DUPLICATE_REASON, check_recipients, screen_recipients
+from .suppression import LOADED, SUPPRESSED_REASON, SuppressionList
+from .tasks import (
+    add_campaign_totals,
+    backoff_delay,
+    dispatch_campaign,
+    generate_suggestions_task,
+    personalise_campaign_task,
+    queue_suggestions,
+    send_email_task,
+    start_campaign,
+)
+from .tracking import dead_letter, mark_tracks
+from .uploads import read_recipient_csv, spool_recipient_csv
+from .validators import check_email_addresses, partition_email_addresses
+from .views import (
+    AIGenerateSuggestionsView,
+    AIJobStatusView,
+    AIJobView,
+    AIPersonaliseView,
+    BulkSendEmailView,
+    CSVValidationView,
+    EmailStatusView,
+    SuppressionListView,
+    decode_status_cursor,
+    encode_status_cursor,
+)
+
+
+class FakeSMTPBackend(BaseEmailBackend):
+    opened = 0
+    drop_next = False
+    refused = set()
+    greylisted = set()
+
+    def open(self):
+        FakeSMTPBackend.opened += 1
+
+    def send_messages(self, email_messages):
+        if FakeSMTPBackend.drop_next:
+            FakeSMTPBackend.drop_next = False
+            raise SMTPServerDisconnected("Connection unexpectedly closed")
+        for message in email_messages:
+            if message.to[0] in FakeSMTPBackend.refused:
+                raise SMTPRecipientsRefused({message.to[0]: (550, b"No such user")})
+            if message.to[0] in FakeSMTPBackend.greylisted:
+                raise SMTPRecipientsRefused({message.to[0]: (451, b"Try again later")})
+        return len(email_messages)
+
+
+class PooledConnectionTests(SimpleTestCase):
+    backend = "users.tests.FakeSMTPBackend"
+
+    def setUp(self):
+        FakeSMTPBackend.opened = 0
+        FakeSMTPBackend.drop_next = False
+
+    def message(self):
+        return EmailMessage("Subject", "Body", "from@gmail.com", ["to@gmail.com"])
+
+    def test_reuses_connection_and_recycles_after_max_messages(self):
+        connection = PooledConnection(max_messages=3, backend=self.backend)
+        for _ in range(7):
+            connection.send(self.message())
+        self.assertEqual(FakeSMTPBackend.opened, 3)
+
+    def test_reconnects_when_server_drops_connection(self):
+        connection = PooledConnection(max_messages=10, backend=self.backend)
+        connection.send(self.message())
+        FakeSMTPBackend.drop_next = True
+        self.assertEqual(connection.send(self.message()), 1)
+        self.assertEqual(FakeSMTPBackend.opened, 2)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class BrokenRedisBuckets:
+    def take(self, buckets, now):
+        raise redis.ConnectionError("Connection refused")
+
+
+class RateLimiterTests(SimpleTestCase):
+    limits = {
+        "sender": {"per_minute": 600, "burst": 5},
+        "domains": {"gmail.com": {"per_minute": 60, "burst": 2}},
+    }
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = RateLimiter(
+            self.limits, clock=self.clock, sleep=self.clock.sleep
+        )
+
+    def test_burst_is_free_then_waits_for_refill(self):
+        self.assertEqual(self.limiter.try_acquire("me", "a@gmail.com"), 0)
+        self.assertEqual(self.limiter.try_acquire("me", "b@gmail.com"), 0)
+        self.assertAlmostEqual(self.limiter.try_acquire("me", "c@gmail.com"), 1.0)
+
+        self.limiter.acquire("me", "c@gmail.com")
+        self.assertEqual(self.clock.sleeps, [1.0])
+
+    def test_domains_have_separate_buckets(self):
+        for i in range(2):
+            self.limiter.acquire("me", f"user{i}@gmail.com")
+        self.assertGreater(self.limiter.try_acquire("me", "c@GMAIL.com"), 0)
+        # yahoo.com has no domain bucket, only the sender bucket applies
+        for i in range(3):
+            self.assertEqual(self.limiter.try_acquire("me", f"user{i}@yahoo.com"), 0)
+        self.assertGreater(self.limiter.try_acquire("me", "last@yahoo.com"), 0)
+
+    def test_falls_back_to_local_buckets_without_redis(self):
+        limiter = RateLimiter(
+            self.limits, backend=BrokenRedisBuckets(), clock=self.clock
+        )
+        self.assertEqual(limiter.try_acquire("me", "a@gmail.com"), 0)
+
+
+class FakeSendLedger:
+    def __init__(self):
+        self.delivered = set()
+
+    def sent(self, campaign_id, emails):
+        return self.delivered.intersection(emails)
+
+    def record(self, campaign_id, email):
+        self.delivered.add(email)
+
+
+class CampaignDispatchTests(SimpleTestCase):
+    def setUp(self):
+        FakeSMTPBackend.opened = 0
+        FakeSMTPBackend.drop_next = False
+        FakeSMTPBackend.refused = {"bad@gmail.com"}
+        FakeSMTPBackend.greylisted = {"busy@gmail.com"}
+        connection = PooledConnection(backend="users.tests.FakeSMTPBackend")
+        patcher = mock.patch(
+            "users.tasks.get_pooled_connection", return_value=connection
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch(
+            "users.tasks.get_rate_limiter", return_value=RateLimiter({})
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.statuses = mock.Mock()
+        patcher = mock.patch("users.tasks.StatusBuffer", return_value=self.statuses)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch("users.tasks.claim_tracks", return_value={})
+        self.claim_tracks = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch("users.tasks.add_suppressions")
+        self.add_suppressions = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch("users.tasks.campaign_owner", return_value=42)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.ledger = FakeSendLedger()
+        patcher = mock.patch("users.tasks.get_send_ledger", return_value=self.ledger)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_refused_recipient_does_not_stop_chunk(self):
+        recipients = [[1, "a@gmail.com"], [2, "bad@gmail.com"], [3, "c@gmail.com"]]
+        result = send_email_task.apply(args=("1", "Subject", "Body", recipients)).get()
+        self.assertEqual(result, {"sent": 2, "failed": 1})
+
+        self.claim_tracks.assert_called_once_with([1, 2, 3], "1")
+        self.assertEqual(self.ledger.delivered, {"a@gmail.com", "c@gmail.com"})
+        self.assertEqual(
+            self.statuses.add.call_args_list,
+            [
+                mock.call(1, "sent", 250),
+                mock.call(2, "failed", 550, "No such user"),
+                mock.call(3, "sent", 250),
+            ],
+        )
+        self.statuses.flush.assert_called()
+        # The 550 was a hard bounce, later sends skip the address
+        self.add_suppressions.assert_called_once_with(42, ["bad@gmail.com"], "bounce")
+
+    def test_redelivered_chunk_skips_checkpointed_recipients(self):
+        # 1 was flushed as sent, 3 was sent but only reached the ledger
+        self.claim_tracks.return_value = {1: "sent"}
+        self.ledger.delivered = {"c@gmail.com"}
+        recipients = [[1, "a@gmail.com"], [2, "d@gmail.com"], [3, "c@gmail.com"]]
+        with mock.patch.object(PooledConnection, "send") as send:
+            result = send_email_task.apply(
+                args=("1", "Subject", "Body", recipients)
+            ).get()
+
+        self.assertEqual(send.call_count, 1)
+        self.assertEqual(send.call_args.args[0].to, ["d@gmail.com"])
+        self.assertEqual(result, {"sent": 3, "failed": 0})
+        self.assertEqual(
+            self.statuses.add.call_args_list,
+            [
+                mock.call(2, "sent", 250),
+                mock.call(3, "sent", None, "Sent before the task restarted"),
+            ],
+        )
+
+    def test_greylisted_recipient_is_retried_later_on_its_own(self):
+        recipients = [[1, "busy@gmail.com"], [2, "a@gmail.com"]]
+        with mock.patch.object(send_email_task, "apply_async") as apply_async:
+            result = send_email_task.apply(
+                args=("1", "Subject", "Body", recipients)
+            ).get()
+
+        # Neither sent nor failed yet, the retry reports it when it's done
+        self.assertEqual(result, {"sent": 1, "failed": 0})
+        self.assertIn(
+            mock.call(1, "deferred", 451, "Try again later"),
+            self.statuses.add.call_args_list,
+        )
+        args, kwargs = apply_async.call_args.args
+        self.assertEqual(args[3], [[1, "busy@gmail.com"]])
+        self.assertEqual(kwargs, {"attempt": 1})
+        self.assertLessEqual(apply_async.call_args.kwargs["countdown"], 30)
+
+    @override_settings(EMAIL_RECIPIENT_MAX_ATTEMPTS=3)
+    def test_recipient_out_of_attempts_is_dead_lettered(self):
+        recipients = [[1, "busy@gmail.com"], [2, "bad@gmail.com"]]
+        with (
+            mock.patch("users.tasks.dead_letter") as dead_letter,
+            mock.patch("users.tasks.add_campaign_totals") as add_campaign_totals,
+        ):
+            result = send_email_task.apply(
+                args=("1", "Subject", "Body", recipients), kwargs={"attempt": 2}
+            ).get()
+
+        self.assertEqual(result, {"sent": 0, "failed": 2})
+        # Only the 4xx recipient, a 5xx is permanent and never retried
+        dead_letter.assert_called_once_with(
+            "1", [(1, "busy@gmail.com", "", 451, "Try again later")], 3
+        )
+        add_campaign_totals.assert_called_once_with("1", result)
+
+    @override_settings(EMAIL_RETRY_BASE_DELAY=10, EMAIL_RETRY_MAX_DELAY=60)
+    def test_backoff_doubles_with_jitter_up_to_the_cap(self):
+        for attempt, ceiling in [(0, 10), (1, 20), (2, 40), (5, 60)]:
+            delay = backoff_delay(attempt)
+            self.assertGreaterEqual(delay, ceiling / 2)
+            self.assertLessEqual(delay, ceiling)
+
+    def test_recipients_are_split_into_chunks(self):
+        recipients = [[i, f"user{i}@gmail.com"] for i in range(5)]
+        with mock.patch("users.tasks.chord") as chord:
+            dispatch_campaign("1", "Subject", "Body", recipients, chunk_size=2)
+        header = chord.call_args.args[0]
+        self.assertEqual([len(task.args[3]) for task in header], [2, 2, 1])
+
+    def test_small_sends_use_the_transactional_queue(self):
+        with mock.patch("users.tasks.chord") as chord:
+            dispatch_campaign("1", "Subject", "Body", [[1, "a@gmail.com"]])
+            dispatch_campaign(
+                "2", "Subject", "Body", [[i, "a@gmail.com"] for i in range(50)]
+            )
+        small, large = [call.args[0][0].options for call in chord.call_args_list]
+        self.assertEqual(small, {"queue": "transactional", "priority": 0})
+        self.assertEqual(large, {"queue": "bulk"})
+
+
+class ArchiveTests(SimpleTestCase):
+    def rows(self):
+        return pd.DataFrame(
+            {
+                "id": [7, 8, 9],
+                "username_id": [1, 1, 1],
+                "campaign_id": ["c1", "c1", None],
+                "status": ["sent", "failed", "fail"],
+            }
+        )
+
+    def test_archive_file_is_named_after_its_first_row(self):
+        with tempfile.TemporaryDirectory() as directory:
+            write_archive(self.rows(), Path(directory) / "2025-01", "csv")
+            path = Path(directory) / "2025-01" / "emailtrack-7.csv.gz"
+            archived = pd.read_csv(path, keep_default_na=False)
+        self.assertEqual(archived["campaign_id"].tolist(), ["c1", "c1", ""])
+
+    def test_daily_totals_cover_user_and_campaign(self):
+        days = pd.Series([datetime(2025, 1, 5).date()] * 3)
+        with mock.patch("users.archive.increment_daily_total") as increment:
+            add_daily_totals(self.rows(), days)
+        day = days[0]
+        self.assertCountEqual(
+            increment.call_args_list,
+            [
+                mock.call(1, None, day, "sent", 1),
+                mock.call(1, "c1", day, "sent", 1),
+                mock.call(1, None, day, "failed", 1),
+                mock.call(1, "c1", day, "failed", 1),
+                mock.call(1, None, day, "fail", 1),
+            ],
+        )
+
+
+class DeliveryCounterTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("counter", "Secret!23")
+        self.campaign = Campaign.objects.create(
+            username=self.user, subject="Hi", body="Hello"
+        )
+
+    def track(self, status, campaign=True):
+        return EmailTrack.objects.create(
+            username=self.user,
+            campaign=self.campaign if campaign else None,
+            recipient=f"{EmailTrack.objects.count()}@gmail.com",
+            status=status,
+        )
+
+    def counters(self):
+        # {(campaign_id, status): count}, leaving out counters back at zero
+        rows = DeliveryCounter.objects.values_list("campaign_id", "status", "count")
+        return {
+            (campaign_id, status): count for campaign_id, status, count in rows if count
+        }
+
+    def test_status_changes_move_both_counters(self):
+        tracks = [self.track("queued") for _ in range(3)]
+        record_status_changes(self.campaign.id, {"queued": 3})
+
+        mark_tracks(
+            [track.id for track in tracks[:2]], "sent", campaign_id=self.campaign.id
+        )
+        mark_tracks([tracks[2].id], "failed", "550 No such user", self.campaign.id)
+
+        for scope in (None, self.campaign.id):
+            counts = dict(
+                DeliveryCounter.objects.filter(campaign_id=scope).values_list(
+                    "status", "count"
+                )
+            )
+            self.assertEqual(counts, {"queued": 0, "sent": 2, "failed": 1})
+        self.assertEqual(
+            user_status_counts(self.user), {"success": 2, "fail": 1, "pending": 0}
+        )
+
+    def test_campaign_finishes_once_no_recipient_is_deferred(self):
+        self.track("sent")
+        deferred = self.track("deferred")
+        record_status_changes(self.campaign.id, {"sent": 1, "deferred": 1})
+
+        # The chord callback runs while the retry is still waiting
+        add_campaign_totals(self.campaign.id, {"sent": 1, "failed": 0})
+        self.campaign.refresh_from_db()
+        self.assertIsNone(self.campaign.finished_at)
+
+        mark_tracks([deferred.id], "sent", campaign_id=self.campaign.id)
+        add_campaign_totals(self.campaign.id, {"sent": 1, "failed": 0})
+        self.campaign.refresh_from_db()
+        self.assertEqual(self.campaign.sent_count, 2)
+        self.assertIsNotNone(self.campaign.finished_at)
+
+    def test_rebuild_matches_tracks_and_archived_totals(self):
+        for status in ["sent", "sent", "failed", "deferred"]:
+            self.track(status)
+            record_status_changes(self.campaign.id, {status: 1}, self.user.id)
+        # Legacy rows from before campaigns only count for the user
+        for status in ["success", "fail"]:
+            self.track(status, campaign=False)
+            increment_counter(self.user.id, status, 1)
+        incremental = self.counters()
+
+        # Half the history moves to the archive, its totals to DailyDeliveryTotal
+        old = EmailTrack.objects.filter(status__in=["sent", "fail"])
+        old.update(email_sent_date=datetime(2024, 1, 15, tzinfo=timezone.utc))
+        with tempfile.TemporaryDirectory() as directory:
+            archived = archive_email_tracks(
+                datetime(2024, 2, 1, tzinfo=timezone.utc), Path(directory), "csv"
+            )
+        self.assertEqual(archived, 3)
+
+        DeliveryCounter.objects.all().delete()
+        self.assertEqual(rebuild_counters([self.user.id]), 5)
+        self.assertEqual(self.counters(), incremental)
+        self.assertEqual(
+            user_status_counts(self.user), {"success": 3, "fail": 2, "pending": 1}
+        )
+
+
+class BackfillCampaignsTests(TestCase):
+    def test_folds_consecutive_legacy_rows_into_campaigns(self):
+        ann = CustomUser.objects.create_user("ann", "Secret!23")
+        bob = CustomUser.objects.create_user("bob", "Secret!23", email="b@gmail.com")
+        base = datetime(2024, 6, 1, 12, 0, tzinfo=timezone.utc)
+        # (owner, subject, message, status, seconds after base)
+        rows = [
+            (ann, "Sale", "Body", "success", 0),
+            (ann, "Sale", "Body", "fail", 1),
+            (bob, "Hello", "Hi", "success", 2),  # another user's send in between
+            (ann, "Sale", "Body", "success", 3),
+            (ann, "Sale", "Other body", "success", 4),  # different message
+            (ann, "Sale", "Other body", "success", 200),  # past the gap
+        ]
+        for user, subject, message, status, seconds in rows:
+            track = EmailTrack.objects.create(
+                username=user,
+                recipient=f"{seconds}@gmail.com",
+                status=status,
+                subject=subject,
+                message=message,
+            )
+            EmailTrack.objects.filter(id=track.id).update(
+                email_sent_date=base + timedelta(seconds=seconds)
+            )
+
+        out = io.StringIO()
+        call_command("backfill_campaigns", gap=60, stdout=out)
+
+        self.assertIn("into 5 campaigns", out.getvalue())
+        campaigns = Campaign.objects.order_by("created_at")
+        self.assertEqual(
+            [
+                (c.username, c.subject, c.body, c.total_recipients)
+                + (c.sent_count, c.failed_count)
+                for c in campaigns
+            ],
+            [
+                (ann, "Sale", "Body", 2, 1, 1),
+                (bob, "Hello", "Hi", 1, 1, 0),
+                (ann, "Sale", "Body", 1, 1, 0),
+                (ann, "Sale", "Other body", 1, 1, 0),
+                (ann, "Sale", "Other body", 1, 1, 0),
+            ],
+        )
+        # Backdated to the send, finished at its last row
+        first = campaigns[0]
+        self.assertEqual(first.created_at, base)
+        self.assertEqual(first.finished_at, base + timedelta(seconds=1))
+
+        tracks = EmailTrack.objects.order_by("id")
+        self.assertFalse(tracks.filter(campaign__isnull=True).exists())
+        self.assertEqual(set(tracks.values_list("subject", "message")), {("", "")})
+        self.assertEqual(
+            [track.campaign_id for track in tracks[:2]], [first.id, first.id]
+        )
+
+
+class ReplayDeadLettersTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("replayer", "Secret!23")
+        patcher = mock.patch("users.tasks.dispatch_campaign")
+        self.dispatch = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def failed_campaign(self, subject, bodies):
+        # A finished campaign whose recipients all ran out of retries
+        campaign = Campaign.objects.create(
+            username=self.user,
+            subject=subject,
+            body="Campaign body",
+            total_recipients=len(bodies),
+            failed_count=len(bodies),
+            finished_at=datetime(2025, 1, 1, tzinfo=timezone.utc),
+        )
+        failures = []
+        for i, body in enumerate(bodies):
+            track = EmailTrack.objects.create(
+                username=self.user,
+                campaign=campaign,
+                recipient=f"{subject.lower()}{i}@gmail.com",
+                status="failed",
+            )
+            failures.append((track.id, track.recipient, body, 451, "Try later"))
+        record_status_changes(campaign.id, {"failed": len(bodies)}, self.user.id)
+        dead_letter(campaign.id, failures, 4)
+        return campaign
+
+    def test_requeues_each_campaigns_letters_in_one_dispatch(self):
+        first = self.failed_campaign("First", ["Dear Ann", ""])
+        second = self.failed_campaign("Second", [""])
+        DeadLetter.objects.filter(campaign=second).update(
+            replayed_at=datetime(2025, 1, 2, tzinfo=timezone.utc)
+        )
+        third = self.failed_campaign("Third", [""])
+
+        out = io.StringIO()
+        call_command("replay_dead_letters", user_ids=[self.user.id], stdout=out)
+
+        self.assertIn("Queued 3 dead-lettered recipients", out.getvalue())
+        # (campaign, recipients requeued, still failed)
+        for campaign, requeued, failed in (
+            (first, 2, 0),
+            (second, 0, 1),
+            (third, 1, 0),
+        ):
+            campaign.refresh_from_db()
+            self.assertEqual(campaign.failed_count, failed)
+            self.assertEqual(campaign.finished_at is None, requeued > 0)
+            counts = dict(
+                DeliveryCounter.objects.filter(campaign=campaign).values_list(
+                    "status", "count"
+                )
+            )
+            self.assertEqual(counts.get("queued", 0), requeued)
+            self.assertEqual(counts["failed"], failed)
+            self.assertEqual(
+                EmailTrack.objects.filter(campaign=campaign, status="queued").count(),
+                requeued,
+            )
+        self.assertFalse(
+            DeadLetter.objects.filter(
+                campaign__in=[first, third], replayed_at=None
+            ).exists()
+        )
+
+        dispatched = {
+            call.args[0]: call.args[3:] for call in self.dispatch.call_args_list
+        }
+        self.assertEqual(len(self.dispatch.call_args_list), 2)
+        recipients, bodies = dispatched[str(first.id)]
+        self.assertEqual(
+            [email for _, email in recipients], ["first0@gmail.com", "first1@gmail.com"]
+        )
+        # Stored bodies, the campaign body where none was stored
+        self.assertEqual(bodies, ["Dear Ann", "Campaign body"])
+        self.assertEqual(dispatched[str(third.id)][1], None)
+
+
+class StartCampaignTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("sender", "Secret!23")
+        patcher = mock.patch("users.tasks.dispatch_campaign")
+        self.dispatch = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start(self):
+        return start_campaign(
+            self.user,
+            "Hi",
+            "Hello",
+            ["a@gmail.com", "b@gmail.com"],
+            [{"email": "bad", "reason": "Invalid email format."}],
+        )
+
+    def test_writes_tracking_rows_and_counters(self):
+        campaign = self.start()
+
+        tracks = EmailTrack.objects.filter(campaign=campaign).order_by("id")
+        self.assertEqual(
+            list(tracks.values_list("recipient", "status", "smtp_response")),
+            [
+                ("a@gmail.com", "queued", ""),
+                ("b@gmail.com", "queued", ""),
+                ("bad", "failed", "Invalid email format."),
+            ],
+        )
+        self.assertEqual((campaign.total_recipients, campaign.failed_count), (3, 1))
+        for scope in (None, campaign.id):
+            counts = dict(
+                DeliveryCounter.objects.filter(campaign_id=scope).values_list(
+                    "status", "count"
+                )
+            )
+            self.assertEqual(counts, {"queued": 2, "failed": 1})
+
+        # Workers get the committed track ids
+        recipients = self.dispatch.call_args.args[3]
+        self.assertEqual(
+            recipients, [[track.id, track.recipient] for track in tracks[:2]]
+        )
+
+    def test_send_with_every_recipient_rejected_is_finished_at_once(self):
+        campaign = start_campaign(
+            self.user,
+            "Hi",
+            "Hello",
+            [],
+            [{"email": "bad", "reason": "Invalid email format."}],
+        )
+
+        self.assertIsNotNone(campaign.finished_at)
+        self.assertEqual((campaign.total_recipients, campaign.failed_count), (1, 1))
+        self.assertEqual(self.dispatch.call_args.args[3], [])
+
+    def test_failed_dispatch_fails_the_queued_rows(self):
+        self.dispatch.side_effect = ConnectionError("broker down")
+        with self.assertRaises(ConnectionError), self.assertLogs("users.tasks"):
+            self.start()
+
+        campaign = Campaign.objects.get()
+        self.assertEqual(campaign.failed_count, 3)
+        self.assertIsNotNone(campaign.finished_at)
+        self.assertEqual(
+            set(EmailTrack.objects.values_list("status", flat=True)), {"failed"}
+        )
+        self.assertEqual(
+            user_status_counts(self.user), {"success": 0, "fail": 3, "pending": 0}
+        )
+
+
+class SendChunkTests(TestCase):
+    # A chunk run end to end: the tracking rows and counters are real, only
+    # SMTP, the rate limiter's and the ledger's Redis, and the broker are faked
+    def setUp(self):
+        FakeSMTPBackend.opened = 0
+        FakeSMTPBackend.drop_next = False
+        FakeSMTPBackend.refused = {"bad@gmail.com"}
+        FakeSMTPBackend.greylisted = {"busy@gmail.com"}
+        self.user = CustomUser.objects.create_user("sender", "Secret!23")
+        connection = PooledConnection(backend="users.tests.FakeSMTPBackend")
+        for patcher in (
+            mock.patch("users.tasks.get_pooled_connection", return_value=connection),
+            mock.patch("users.tasks.get_rate_limiter", return_value=RateLimiter({})),
+            mock.patch("users.tasks.get_send_ledger", return_value=FakeSendLedger()),
+            mock.patch("users.suppression.get_suppression_list"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch("users.tasks.chord")
+        self.chord = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(send_email_task, "apply_async")
+        self.apply_async = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start(self, emails):
+        campaign = start_campaign(self.user, "Hi", "Hello", emails, [])
+        (chunk,) = self.chord.call_args.args[0]
+        return campaign, chunk
+
+    def finish(self, campaign, results):
+        callback = self.chord.return_value.call_args.args[0]
+        callback.apply(args=(results,)).get()
+        campaign.refresh_from_db()
+
+    def statuses(self, campaign):
+        tracks = EmailTrack.objects.filter(campaign=campaign).order_by("id")
+        return list(tracks.values_list("recipient", "status", "smtp_code"))
+
+    def counts(self, campaign):
+        counters = DeliveryCounter.objects.filter(campaign=campaign, count__gt=0)
+        return dict(counters.values_list("status", "count"))
+
+    def test_chunk_writes_each_outcome_to_its_row_and_counters(self):
+        campaign, chunk = self.start(["a@gmail.com", "bad@gmail.com", "busy@gmail.com"])
+
+        result = chunk.apply().get()
+        self.finish(campaign, [result])
+
+        self.assertEqual(result, {"sent": 1, "failed": 1})
+        self.assertEqual(
+            self.statuses(campaign),
+            [
+                ("a@gmail.com", "sent", 250),
+                ("bad@gmail.com", "failed", 550),
+                ("busy@gmail.com", "deferred", 451),
+            ],
+        )
+        self.assertEqual(self.counts(campaign), {"sent": 1, "failed": 1, "deferred": 1})
+        self.assertEqual(
+            user_status_counts(self.user), {"success": 1, "fail": 1, "pending": 1}
+        )
+        self.assertEqual(
+            list(Suppression.objects.values_list("email", "reason")),
+            [("bad@gmail.com", "bounce")],
+        )
+        # The deferred recipient still keeps the campaign open
+        self.assertEqual((campaign.sent_count, campaign.failed_count), (1, 1))
+        self.assertIsNone(campaign.finished_at)
+
+        # Its retry delivers it and finishes the campaign
+        args, kwargs = self.apply_async.call_args.args
+        self.assertEqual(args[3], [[chunk.args[3][2][0], "busy@gmail.com"]])
+        FakeSMTPBackend.greylisted = set()
+        send_email_task.apply(args=args, kwargs=kwargs).get()
+
+        campaign.refresh_from_db()
+        self.assertEqual(self.statuses(campaign)[2], ("busy@gmail.com", "sent", 250))
+        self.assertEqual(self.counts(campaign), {"sent": 2, "failed": 1})
+        self.assertEqual((campaign.sent_count, campaign.failed_count), (2, 1))
+        self.assertIsNotNone(campaign.finished_at)
+
+    def test_connection_error_leaves_the_rest_of_the_chunk_deferred(self):
+        campaign, chunk = self.start(["a@gmail.com", "b@gmail.com", "c@gmail.com"])
+        # The server goes away after the first message, reconnecting fails too
+        dropped = SMTPServerDisconnected("Connection unexpectedly closed")
+
+        # The worker hands the retry back to the broker
+        with (
+            mock.patch.object(
+                FakeSMTPBackend, "send_messages", side_effect=[1, dropped, dropped]
+            ),
+            mock.patch.object(send_email_task, "retry", side_effect=Retry()) as retry,
+            self.assertLogs("users", "WARNING"),
+        ):
+            self.assertEqual(chunk.apply().state, "RETRY")
+
+        self.assertEqual(
+            self.statuses(campaign),
+            [
+                ("a@gmail.com", "sent", 250),
+                ("b@gmail.com", "deferred", None),
+                ("c@gmail.com", "deferred", None),
+            ],
+        )
+        self.assertEqual(self.counts(campaign), {"sent": 1, "deferred": 2})
+        self.assertEqual(
+            user_status_counts(self.user), {"success": 1, "fail": 0, "pending": 2}
+        )
+        kwargs = retry.call_args.kwargs["kwargs"]
+        self.assertEqual(kwargs, {"start": 1, "failed": 0, "deferred": 0, "attempt": 0})
+
+        # The retried chunk resumes from where the connection dropped
+        result = send_email_task.apply(args=chunk.args, kwargs=kwargs).get()
+        self.finish(campaign, [result])
+
+        self.assertEqual(result, {"sent": 3, "failed": 0})
+        self.assertEqual(
+            [status for _, status, _ in self.statuses(campaign)], ["sent"] * 3
+        )
+        self.assertEqual(self.counts(campaign), {"sent": 3})
+        self.assertEqual((campaign.sent_count, campaign.failed_count), (3, 0))
+        self.assertIsNotNone(campaign.finished_at)
+
+
+class FakeSetRedis:
+    def __init__(self, sets):
+        self.sets = sets
+        self.lookups = 0
+
+    def exists(self, key):
+        return key in self.sets
+
+    def smismember(self, key, members):
+        self.lookups += 1
+        return [member in self.sets[key] for member in members]
+
+
+class BrokenRedis:
+    def exists(self, key):
+        raise redis.ConnectionError("Connection refused")
+
+
+class SuppressionListTests(SimpleTestCase):
+    def test_one_lookup_for_the_distinct_normalised_addresses(self):
+        client = FakeSetRedis({"suppressed:1": {LOADED, "gone@gmail.com"}})
+        suppressed = SuppressionList(client).suppressed(
+            1, ["a@gmail.com", " Gone@Gmail.com", "gone@gmail.com", "b@yahoo.com"]
+        )
+        self.assertEqual(suppressed.tolist(), [False, True, True, False])
+        self.assertEqual(client.lookups, 1)
+
+    def test_falls_back_to_the_database_without_redis(self):
+        suppressions = SuppressionList(BrokenRedis())
+        with mock.patch.object(
+            suppressions, "lookup_database", return_value={"gone@gmail.com"}
+        ) as lookup_database:
+            suppressed = suppressions.suppressed(1, ["GONE@gmail.com", "a@gmail.com"])
+        self.assertEqual(suppressed.tolist(), [True, False])
+        lookup_database.assert_called_once_with(1, ["gone@gmail.com", "a@gmail.com"])
+
+
+class SuppressionImportTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("suppressor", "Secret!23")
+        patcher = mock.patch("users.suppression.get_suppression_list")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, content, **data):
+        upload = SimpleUploadedFile("suppressions.csv", content.encode())
+        request = APIRequestFactory().post(
+            "/api/users/suppressions/", {"file": upload, **data}
+        )
+        force_authenticate(request, user=self.user)
+        return SuppressionListView.as_view()(request)
+
+    def test_reimported_export_keeps_each_reason(self):
+        response = self.post(
+            "email,reason,created_at\n"
+            "a@gmail.com,bounce,2025-01-01\n"
+            "B@gmail.com,unsubscribe,2025-01-02\n"
+            "c@gmail.com,,2025-01-03\n",
+            reason="complaint",
+        )
+
+        self.assertEqual(response.data, {"added": 3})
+        self.assertEqual(
+            dict(Suppression.objects.values_list("email", "reason")),
+            {
+                "a@gmail.com": "bounce",
+                "b@gmail.com": "unsubscribe",
+                "c@gmail.com": "complaint",
+            },
+        )
+
+    def test_rejects_files_without_an_email_column_or_with_unknown_reasons(self):
+        response = self.post("address\na@gmail.com\n")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {"error": ["Missing required column: email"]})
+
+        response = self.post("email,reason\na@gmail.com,spam\n")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Suppression.objects.exists())
+
+
+@override_settings(EMAIL_FREQUENCY_CAP=2, EMAIL_FREQUENCY_WINDOW_HOURS=24)
+class RecipientScreeningTests(SimpleTestCase):
+    def test_repeats_suppressed_and_capped_recipients_are_skipped(self):
+        suppressions = SuppressionList(
+            FakeSetRedis({"suppressed:1": {LOADED, "gone@gmail.com"}})
+        )
+        with (
+            mock.patch(
+                "users.screening.get_suppression_list", return_value=suppressions
+            ),
+            mock.patch(
+                "users.screening.recent_send_counts",
+                return_value={"busy@gmail.com": 2, "once@gmail.com": 1},
+            ) as recent_send_counts,
+        ):
+            reasons = screen_recipients(
+                1,
+                [
+                    "a@gmail.com",
+                    " A@Gmail.com",
+                    "gone@gmail.com",
+                    "Busy@gmail.com",
+                    "once@gmail.com",
+                ],
+            )
+
+        capped = "Recipient already received 2 emails in the last 24 hours."
+        self.assertEqual(
+            reasons.tolist(),
+            ["", DUPLICATE_REASON, SUPPRESSED_REASON, capped, ""],
+        )
+        # Only addresses still in the running are looked up
+        self.assertEqual(
+            recent_send_counts.call_args.args[1],
+            ["a@gmail.com", "busy@gmail.com", "once@gmail.com"],
+        )
+
+    @override_settings(EMAIL_MX_CHECK=False)
+    def test_check_recipients_validates_then_screens_the_valid_ones(self):
+        suppressions = SuppressionList(FakeSetRedis({"suppressed:1": {LOADED}}))
+        with (
+            mock.patch(
+                "users.screening.get_suppression_list", return_value=suppressions
+            ),
+            mock.patch("users.screening.recent_send_counts", return_value={}),
+        ):
+            valid, invalid = check_recipients(
+                1, ["a@gmail.com", "nope", "A@gmail.com", "b@gmail.com"]
+            )
+
+        self.assertEqual(valid.tolist(), [True, False, False, True])
+        self.assertEqual(
+            invalid,
+            [
+                {"email": "nope", "reason": "Invalid email format."},
+                {"email": "A@gmail.com", "reason": DUPLICATE_REASON},
+            ],
+        )
+
+
+class TemplateRenderingTests(SimpleTestCase):
+    def test_replaces_every_occurrence_of_any_column(self):
+        template = compile_template("Hi {first_name}, {first_name} from {city}!")
+        row = {"first_name": "Ann", "city": "Pune"}
+        self.assertEqual(template.render(row), "Hi Ann, Ann from Pune!")
+
+    def test_defaults_missing_fields_and_escaping(self):
+        template = compile_template("{{Hi}} {first_name|there} {unknown} {plan|free}")
+        self.assertEqual(template.render({"plan": ""}), "{Hi} there {unknown} free")
+        self.assertEqual(
+            compile_template("<p>{name}</p>").render({"name": "<b>"}, escape=True),
+            "<p>&lt;b&gt;</p>",
+        )
+
+    def test_compiled_template_cache_follows_edits(self):
+        template = mock.Mock(id=1, created_template="Hello {first_name}")
+        compiled = get_compiled_template(template)
+        self.assertIs(get_compiled_template(template), compiled)
+
+        template.created_template = "Bye {first_name}"
+        self.assertEqual(
+            get_compiled_template(template).render({"first_name": "A"}), "Bye A"
+        )
+
+
+RECIPIENT_CSV = (
+    "email,first_name\n"
+    "a@gmail.com,Ann\n"
+    "not-an-email,Bob\n"
+    "c@yahoo.com,Cy\n"
+    "d@gmail.com,Di\n"
+    "e@outlook.com,Ed\n"
+)
+
+
+@override_settings(EMAIL_MX_CHECK=False)
+class RecipientSpoolTests(SimpleTestCase):
+    def spool(self, content):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "upload.csv"
+            with mock.patch(
+                "users.uploads.check_email_addresses", wraps=check_email_addresses
+            ) as check:
+                summary = spool_recipient_csv(io.StringIO(content), path, chunksize=2)
+            spooled = path.read_text()
+        return summary, spooled, check
+
+    def test_validates_chunk_by_chunk_and_spools_accepted_rows(self):
+        summary, spooled, check = self.spool(RECIPIENT_CSV)
+
+        # Three chunks of at most two rows, one header in the spool
+        self.assertEqual([len(c.args[0]) for c in check.call_args_list], [2, 2, 1])
+        self.assertEqual(
+            spooled.splitlines(),
+            [
+                "email,first_name",
+                "a@gmail.com,Ann",
+                "c@yahoo.com,Cy",
+                "d@gmail.com,Di",
+                "e@outlook.com,Ed",
+            ],
+        )
+        self.assertEqual(
+            summary,
+            {
+                "columns": ["email", "first_name"],
+                "total_rows": 5,
+                "valid_rows": 4,
+                "invalid_rows": 1,
+                "invalid_sample": [
+                    {"email": "not-an-email", "reason": "Invalid email format."}
+                ],
+                "errors": [],
+            },
+        )
+
+    def test_missing_columns_stop_before_any_row_is_checked(self):
+        summary, spooled, check = self.spool("email\na@gmail.com\n")
+        self.assertEqual(summary["errors"], ["Missing required column: first_name"])
+        check.assert_not_called()
+        self.assertEqual(spooled, "")
+
+
+@override_settings(EMAIL_MX_CHECK=False, CSV_VALIDATION_CHUNK_SIZE=2)
+class CSVStreamValidationTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("uploader", "Secret!23")
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.spool_dir = Path(directory.name)
+        spool_settings = override_settings(UPLOAD_SPOOL_DIR=self.spool_dir)
+        spool_settings.enable()
+        self.addCleanup(spool_settings.disable)
+
+    def post(self, content):
+        upload = SimpleUploadedFile("recipients.csv", content.encode())
+        request = APIRequestFactory().post(
+            "/api/users/validate-csv/", {"file": upload, "mode": "stream"}
+        )
+        force_authenticate(request, user=self.user)
+        response = CSVValidationView.as_view()(request)
+        return response.status_code, json.loads(response.content)
+
+    def test_returns_a_summary_and_records_the_upload(self):
+        status_code, body = self.post(RECIPIENT_CSV)
+
+        self.assertEqual(status_code, 200)
+        self.assertNotIn("data", body)
+        self.assertEqual((body["total_rows"], body["invalid_rows"]), (5, 1))
+        upload = RecipientUpload.objects.get(id=body["upload_id"])
+        self.assertEqual((upload.valid_rows, upload.username_id), (4, self.user.id))
+        self.assertEqual(len(read_recipient_csv(upload.spool_path)), 4)
+
+    def test_rejected_upload_leaves_no_spool_file(self):
+        status_code, body = self.post("email\na@gmail.com\n")
+
+        self.assertEqual(status_code, 400)
+        self.assertEqual(body, {"error": ["Missing required column: first_name"]})
+        self.assertFalse(RecipientUpload.objects.exists())
+        self.assertEqual(list(self.spool_dir.iterdir()), [])
+
+
+@override_settings(EMAIL_MX_CHECK=False, EMAIL_CHUNK_SIZE=2)
+class BulkSendEmailTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("bulk", "Secret!23")
+        self.other = CustomUser.objects.create_user(
+            "other", "Secret!23", email="other@gmail.com"
+        )
+        suppressions = SuppressionList(
+            FakeSetRedis({f"suppressed:{self.user.id}": {LOADED}})
+        )
+        for patcher in (
+            mock.patch(
+                "users.screening.get_suppression_list", return_value=suppressions
+            ),
+            mock.patch("users.tasks.chord"),
+        ):
+            patched = patcher.start()
+            self.addCleanup(patcher.stop)
+        self.chord = patched
+
+    def post(self, **data):
+        request = APIRequestFactory().post(
+            "/api/users/bulk-send-email/", {"subject": "Sale", **data}
+        )
+        force_authenticate(request, user=self.user)
+        return BulkSendEmailView.as_view()(request)
+
+    def csv(self, content=RECIPIENT_CSV):
+        return SimpleUploadedFile("recipients.csv", content.encode())
+
+    def chunks(self):
+        # (recipients, bodies) of every send_email_task in the chord
+        header = self.chord.call_args.args[0]
+        return [([email for _, email in sig.args[3]], sig.args[4]) for sig in header]
+
+    def test_renders_the_stored_template_into_chunked_bodies(self):
+        template = EmailTemplate.objects.create(
+            username=self.user, created_template="Hi {first_name}"
+        )
+        response = self.post(file=self.csv(), template_id=template.id)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["sent_count"], 4)
+        self.assertEqual(response.data["not_sent_to"], ["not-an-email"])
+        self.assertEqual(
+            self.chunks(),
+            [
+                (["a@gmail.com", "c@yahoo.com"], ["Hi Ann", "Hi Cy"]),
+                (["d@gmail.com", "e@outlook.com"], ["Hi Di", "Hi Ed"]),
+            ],
+        )
+        campaign = Campaign.objects.get(id=response.data["campaign_id"])
+        self.assertEqual(
+            (campaign.template, campaign.body), (template, "Hi {first_name}")
+        )
+
+    def test_sends_a_validated_upload(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "upload.csv"
+            path.write_text("email,first_name\na@gmail.com,\n")
+            upload = RecipientUpload.objects.create(
+                username=self.user, file_name="recipients.csv", spool_path=path
+            )
+            response = self.post(
+                upload_id=upload.id, message="Hello {first_name|there}"
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.chunks(), [(["a@gmail.com"], ["Hello there"])])
+
+    def test_missing_or_foreign_template_or_upload_is_not_found(self):
+        foreign_template = EmailTemplate.objects.create(
+            username=self.other, created_template="Hi"
+        )
+        foreign_upload = RecipientUpload.objects.create(
+            username=self.other, file_name="theirs.csv", spool_path="theirs.csv"
+        )
+        for data in [
+            {"file": self.csv(), "template_id": foreign_template.id},
+            {"file": self.csv(), "template_id": "nope"},
+            {"upload_id": foreign_upload.id, "message": "Hi"},
+            {"upload_id": "not-a-uuid", "message": "Hi"},
+        ]:
+            with self.subTest(data=data):
+                self.assertEqual(self.post(**data).status_code, 404)
+        self.chord.assert_not_called()
+
+    def test_csv_missing_required_columns_is_rejected(self):
+        response = self.post(file=self.csv("email\na@gmail.com\n"), message="Hi")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.data, {"error": ["Missing required column: first_name"]}
+        )
+        self.assertFalse(Campaign.objects.exists())
+
+
+class EmailAddressValidationTests(SimpleTestCase):
+    def test_partitions_addresses_with_reasons(self):
+        valid, invalid = partition_email_addresses(
+            ["a@gmail.com", "B@Yahoo.COM", "c@example.com", "not-an-email", None]
+        )
+        self.assertEqual(valid, ["a@gmail.com", "B@Yahoo.COM"])
+        self.assertEqual(
+            [item["reason"] for item in invalid],
+            [
+                "Email domain is not allowed.",
+                "Invalid email format.",
+                "Invalid email format.",
+            ],
+        )
+
+    def test_empty_list(self):
+        self.assertEqual(partition_email_addresses([]), ([], []))
+
+
+class StubResolver:
+    # Answers from a {(domain, rdtype): records or exception} table
+    def __init__(self, answers):
+        self.answers = answers
+        self.queries = []
+        self.in_flight = self.max_in_flight = 0
+
+    async def resolve(self, domain, rdtype):
+        self.queries.append((domain, rdtype))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        answer = self.answers.get((domain, rdtype), dns.resolver.NoAnswer())
+        if isinstance(answer, Exception):
+            raise answer
+        return [mock.Mock(exchange=dns.name.from_text(host)) for host in answer]
+
+
+class DeliverabilityTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.resolver = StubResolver(
+            {
+                ("mail.com", "MX"): ["mx1.mail.com", "mx2.mail.com"],
+                ("gone.com", "MX"): dns.resolver.NXDOMAIN(),
+                ("nomail.com", "MX"): ["."],
+                ("bare.com", "A"): ["192.0.2.1"],
+                ("slow.com", "MX"): dns.resolver.LifetimeTimeout(),
+            }
+        )
+        self.checker = DeliverabilityChecker(self.resolver, concurrency=2)
+
+    def test_classifies_domains_and_caches_answers(self):
+        domains = ["mail.com", "gone.com", "nomail.com", "bare.com", "slow.com"]
+        results = self.checker.check(domains + ["MAIL.com"])
+        self.assertEqual(
+            results,
+            {
+                "mail.com": True,
+                "gone.com": False,
+                "nomail.com": False,
+                "bare.com": True,
+                "slow.com": None,
+            },
+        )
+        self.assertLessEqual(self.resolver.max_in_flight, 2)
+
+        # Negative answers come from the cache too, only the timeout is retried
+        self.resolver.queries = []
+        self.assertEqual(self.checker.check(domains), results)
+        self.assertEqual(self.resolver.queries, [("slow.com", "MX")])
+
+    @override_settings(EMAIL_MX_CHECK=True, ALLOWED_RECIPIENT_DOMAINS=set())
+    def test_validation_looks_up_each_domain_once(self):
+        with mock.patch(
+            "users.validators.get_deliverability_checker", return_value=self.checker
+        ):
+            checked = check_email_addresses(
+                ["a@mail.com", "b@Mail.com", "c@gone.com", "d@slow.com"]
+            )
+        self.assertEqual(
+            checked["reason"].tolist(),
+            ["", "", "Email domain does not accept mail.", ""],
+        )
+        self.assertEqual(
+            [query for query in self.resolver.queries if query[1] == "MX"],
+            [("mail.com", "MX"), ("gone.com", "MX"), ("slow.com", "MX")],
+        )
+
+    def test_lookups_past_the_deadline_are_unanswered_and_not_cached(self):
+        resolve = self.resolver.resolve
+
+        async def hang_on_one_domain(domain, rdtype):
+            if domain == "hang.com":
+                await asyncio.sleep(10)
+            return await resolve(domain, rdtype)
+
+        self.resolver.resolve = hang_on_one_domain
+        checker = DeliverabilityChecker(self.resolver, deadline=0.2)
+        started = time.monotonic()
+        results = checker.check(["mail.com", "hang.com"])
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(results, {"mail.com": True, "hang.com": None})
+        self.assertIsNone(cache.get(checker.cache_key("hang.com")))
+
+    def test_a_spent_deadline_skips_the_remaining_lookups(self):
+        results = self.checker.check(["mail.com"], deadline=time.monotonic() - 1)
+        self.assertEqual(results, {"mail.com": None})
+        self.assertEqual(self.resolver.queries, [])
+
+    @override_settings(EMAIL_MX_CHECK=True, ALLOWED_RECIPIENT_DOMAINS=set())
+    def test_an_upload_shares_one_deadline_across_its_chunks(self):
+        with (
+            mock.patch(
+                "users.uploads.get_deliverability_checker", return_value=self.checker
+            ),
+            mock.patch(
+                "users.validators.get_deliverability_checker",
+                return_value=self.checker,
+            ),
+            mock.patch.object(self.checker, "check", return_value={}) as check,
+            tempfile.TemporaryDirectory() as directory,
+        ):
+            spool_recipient_csv(
+                io.StringIO(RECIPIENT_CSV), Path(directory) / "upload.csv", 2
+            )
+        deadlines = {call.args[1] for call in check.call_args_list}
+        self.assertEqual(check.call_count, 3)
+        self.assertEqual(len(deadlines), 1)
+
+
+class EmailStatusPagingTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("pager", "Secret!23")
+        other = CustomUser.objects.create_user(
+            "neighbour", "Secret!23", email="neighbour@gmail.com"
+        )
+        campaign = Campaign.objects.create(
+            username=self.user, subject="Launch", body="Campaign body"
+        )
+        base = datetime(2025, 3, 1, 9, 0, tzinfo=timezone.utc)
+        # Two pairs share a timestamp, so paging has to break ties on id
+        rows = [
+            (self.user, "sent", 0),
+            (self.user, "success", 1),
+            (self.user, "sent", 1),
+            (self.user, "failed", 2),
+            (self.user, "success", 3),
+            (self.user, "sent", 3),
+            (self.user, "sent", 4),
+            (other, "sent", 5),
+        ]
+        for i, (user, status, minute) in enumerate(rows):
+            legacy = status == "success"
+            track = EmailTrack.objects.create(
+                username=user,
+                campaign=None if legacy else campaign,
+                recipient=f"r{i}@gmail.com",
+                status=status,
+                subject="Old subject" if legacy else "",
+                message="Old body" if legacy else "",
+            )
+            EmailTrack.objects.filter(id=track.id).update(
+                email_sent_date=base + timedelta(minutes=minute)
+            )
+
+    def page(self, cursor=None):
+        params = {"status": "success", "page_size": 2, "include_message": "true"}
+        if cursor:
+            params["cursor"] = cursor
+        request = APIRequestFactory().get("/api/users/email-status/", params)
+        force_authenticate(request, user=self.user)
+        response = EmailStatusView.as_view()(request)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_pages_a_mixed_group_newest_first_without_gaps(self):
+        emails, cursor = [], None
+        pages = 0
+        while True:
+            data = self.page(cursor)
+            pages += 1
+            emails += data["emails"]
+            cursor = data["next"]
+            if not cursor:
+                break
+
+        self.assertEqual(pages, 3)
+        # Newest first, ties broken by the later id; the failed row and the
+        # other user's row stay out
+        self.assertEqual(
+            [email["recipient"] for email in emails],
+            ["r6@gmail.com", "r5@gmail.com", "r4@gmail.com", "r2@gmail.com"]
+            + ["r1@gmail.com", "r0@gmail.com"],
+        )
+        self.assertEqual(
+            [(email["subject"], email["message"]) for email in emails[2:4]],
+            [("Old subject", "Old body"), ("Launch", "Campaign body")],
+        )
+
+
+class EmailStatusCursorTests(SimpleTestCase):
+    def test_cursor_round_trip(self):
+        sent_date = datetime(2024, 5, 1, 12, 30, 15, 120, tzinfo=timezone.utc)
+        cursor = encode_status_cursor({"email_sent_date": sent_date, "id": 42})
+        self.assertEqual(decode_status_cursor(cursor), (sent_date, 42))
+        self.assertIsNone(decode_status_cursor(None))
+
+    def test_rejects_malformed_cursor(self):
+        for cursor in ["zzz", "bm90LWEtY3Vyc29y"]:
+            with self.assertRaises(ValueError):
+                decode_status_cursor(cursor)
+
+
+class ResponseCacheTests(TestCase):
+    def request(self, **headers):
+        request = RequestFactory().get("/api/users/get-user-templates/", **headers)
+        request.user = mock.Mock(id=7)
+        return request
+
+    def invalidate(self):
+        # Versions are bumped once the surrounding transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_user_cache(TEMPLATES, 7)
+
+    def test_serves_cached_data_until_invalidated(self):
+        build = mock.Mock(return_value={"templates": []})
+        self.invalidate()
+        first = cached_response(self.request(), TEMPLATES, build)
+        cached_response(self.request(), TEMPLATES, build)
+        self.assertEqual(build.call_count, 1)
+
+        not_modified = cached_response(
+            self.request(HTTP_IF_NONE_MATCH=first["ETag"]), TEMPLATES, build
+        )
+        self.assertEqual(not_modified.status_code, 304)
+
+        self.invalidate()
+        cached_response(self.request(), TEMPLATES, build)
+        self.assertEqual(build.call_count, 2)
+
+    def test_cache_outage_serves_from_build_and_skips_invalidation(self):
+        build = mock.Mock(return_value={"templates": []})
+        broken = mock.Mock(spec=["get", "add", "set", "incr"])
+        for method in ("get", "add", "set", "incr"):
+            getattr(broken, method).side_effect = redis.ConnectionError("down")
+        with (
+            mock.patch("users.caching.cache", broken),
+            self.assertLogs("users.caching", "WARNING") as logs,
+        ):
+            response = cached_response(self.request(), TEMPLATES, build)
+            self.invalidate()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {"templates": []})
+        self.assertEqual(len(logs.records), 2)
+
+
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    # Streams /api/generate replies the way Ollama does, one JSON object a line
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if "fail" in payload["prompt"]:
+            self.send_response(500)
+            self.end_headers()
+            self.wfile.write(b'{"error": "model not found"}')
+            return
+        if "opening line" in payload["prompt"]:
+            self.personal_opener(payload["prompt"])
+            return
+        tokens = ["Big ", "sale"] if "one-line" in payload["prompt"] else ["Hi ", "all"]
+        self.stream(tokens)
+
+    def personal_opener(self, prompt):
+        cls = StubOllamaHandler
+        with cls.lock:
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        time.sleep(0.02)
+        name = re.search(r"first_name: (\w+)", prompt).group(1)
+        with cls.lock:
+            cls.in_flight -= 1
+        self.stream(["Dear ", name])
+
+    def stream(self, tokens):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        for token in tokens:
+            self.wfile.write(json.dumps({"response": token, "done": False}).encode())
+            self.wfile.write(b"\n")
+        self.wfile.write(b'{"response": "", "done": true}\n')
+
+    def log_message(self, *args):
+        pass
+
+
+class StubOllamaMixin:
+    # Points OLLAMA_URL at a StubOllamaHandler server for the whole class
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubOllamaHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.settings = override_settings(
+            OLLAMA_URL=f"http://127.0.0.1:{cls.server.server_address[1]}"
+        )
+        cls.settings.enable()
+        # The shared client is bound to the Ollama URL it was created with
+        run(close_client())
+
+    @classmethod
+    def tearDownClass(cls):
+        run(close_client())
+        cls.settings.disable()
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+
+class AISuggestionTests(StubOllamaMixin, SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch("users.ai._suggestion_cache", SuggestionCache())
+        self.cache = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, data):
+        request = APIRequestFactory().post(
+            "/api/users/ai-suggestions/", data, format="json"
+        )
+        force_authenticate(request, user=mock.Mock(is_authenticated=True))
+        return AIGenerateSuggestionsView.as_view()(request)
+
+    def test_generates_subject_and_body(self):
+        suggestions = run(generate_suggestions("New year sale"))
+        self.assertEqual(suggestions, {"subject": "Big sale", "body": "Hi all"})
+
+    def test_repeat_prompt_is_served_from_cache(self):
+        run(generate_suggestions("New Year Sale"))
+        with mock.patch("users.ai.stream_completion") as stream_completion:
+            suggestions = run(generate_suggestions("  new year SALE! "))
+        stream_completion.assert_not_called()
+        self.assertEqual(suggestions["subject"], "Big sale")
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+    def test_streams_tokens_as_ndjson(self):
+        response = self.post({"description": "New year sale", "stream": True})
+        # A sync iterator, which WSGI servers flush line by line
+        self.assertFalse(response.is_async)
+
+        content = b"".join(response.streaming_content)
+        events = [json.loads(line) for line in content.splitlines()]
+        subject = "".join(e["token"] for e in events if e.get("field") == "subject")
+        self.assertEqual(subject, "Big sale")
+        self.assertEqual(events[-1], {"done": True})
+
+    def test_personalises_rows_with_bounded_concurrency(self):
+        StubOllamaHandler.max_in_flight = 0
+        rows = [{"email": f"{name}@gmail.com", "first_name": name} for name in "ABCDEF"]
+        openers = run(personalise_openers("Sale", rows, concurrency=2))
+        self.assertEqual(openers, [f"Dear {name}" for name in "ABCDEF"])
+        self.assertEqual(StubOllamaHandler.max_in_flight, 2)
+
+    def test_reports_model_errors(self):
+        response = self.post({"description": "fail please"})
+        self.assertEqual(response.status_code, 500)
+
+
+@override_settings(EMAIL_FREQUENCY_CAP=0)
+class PersonaliseCampaignTests(StubOllamaMixin, TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("writer", "Secret!23")
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        spool = Path(directory.name) / "upload.csv"
+        spool.write_text(
+            "email,first_name\n"
+            "a@gmail.com,Ann\n"
+            "gone@gmail.com,Gus\n"
+            "b@gmail.com,Bo\n"
+            "A@gmail.com,Ann\n"
+        )
+        self.upload = RecipientUpload.objects.create(
+            username=self.user, file_name="recipients.csv", spool_path=spool
+        )
+        suppressions = SuppressionList(
+            FakeSetRedis({f"suppressed:{self.user.id}": {LOADED, "gone@gmail.com"}})
+        )
+        for patcher in (
+            mock.patch(
+                "users.screening.get_suppression_list", return_value=suppressions
+            ),
+            mock.patch("users.tasks.dispatch_campaign"),
+        ):
+            self.dispatch = patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_sends_each_recipient_an_opener_before_the_rendered_body(self):
+        result = personalise_campaign_task(
+            self.user.id, str(self.upload.id), "Sale", "Spring sale", "Hi {first_name}"
+        )
+
+        self.assertEqual(
+            {key: result[key] for key in ("recipients", "personalised")},
+            {"recipients": 2, "personalised": 2},
+        )
+        self.assertGreater(result["recipients_per_minute"], 0)
+        self.assertIn("seconds", result)
+
+        tracks = EmailTrack.objects.filter(campaign_id=result["campaign_id"])
+        self.assertEqual(
+            list(tracks.order_by("id").values_list("recipient", "status", "message")),
+            [
+                ("a@gmail.com", "queued", "Dear Ann\n\nHi Ann"),
+                ("b@gmail.com", "queued", "Dear Bo\n\nHi Bo"),
+                ("gone@gmail.com", "failed", ""),
+                ("A@gmail.com", "failed", ""),
+            ],
+        )
+        self.assertEqual(
+            list(
+                tracks.filter(status="failed").values_list("smtp_response", flat=True)
+            ),
+            [SUPPRESSED_REASON, DUPLICATE_REASON],
+        )
+        self.assertEqual(
+            self.dispatch.call_args.args[4], ["Dear Ann\n\nHi Ann", "Dear Bo\n\nHi Bo"]
+        )
+
+    def test_view_queues_the_job_for_the_users_own_upload(self):
+        other = CustomUser.objects.create_user(
+            "other", "Secret!23", email="o@gmail.com"
+        )
+        data = {
+            "subject": "Sale",
+            "description": "Spring sale",
+            "message": "Hi {first_name}",
+            "upload_id": str(self.upload.id),
+        }
+        with mock.patch.object(personalise_campaign_task, "delay") as delay:
+            delay.return_value.id = "job-1"
+            request = APIRequestFactory().post("/api/users/ai-personalise/", data)
+            force_authenticate(request, user=self.user)
+            response = AIPersonaliseView.as_view()(request)
+
+            request = APIRequestFactory().post("/api/users/ai-personalise/", data)
+            force_authenticate(request, user=other)
+            foreign = AIPersonaliseView.as_view()(request)
+
+        self.assertEqual(
+            (response.status_code, response.data), (202, {"job_id": "job-1"})
+        )
+        delay.assert_called_once_with(
+            self.user.id,
+            str(self.upload.id),
+            "Sale",
+            "Spring sale",
+            "Hi {first_name}",
+            None,
+        )
+        self.assertEqual(foreign.status_code, 404)
+
+
+class SuggestionCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = SuggestionCache(max_size=2, ttl=60, clock=self.clock)
+
+    def test_entries_expire_and_least_recent_is_evicted(self):
+        self.cache.set("a", "llama3.2", 1)
+        self.cache.set("b", "llama3.2", 2)
+        self.cache.get("a", "llama3.2")
+        self.cache.set("c", "llama3.2", 3)
+        self.assertIsNone(self.cache.get("b", "llama3.2"))
+        self.assertIsNone(self.cache.get("a", "other-model"))
+
+        self.clock.now += 61
+        self.assertIsNone(self.cache.get("a", "llama3.2"))
+
+    def test_nearest_matches_similar_embeddings_of_the_same_model(self):
+        self.cache.set("new year sale", "llama3.2", "sale", embedding=[1.0, 0.0])
+        self.assertEqual(self.cache.nearest([0.99, 0.05], "llama3.2", 0.95), "sale")
+        self.assertIsNone(self.cache.nearest([0.0, 1.0], "llama3.2", 0.95))
+        self.assertIsNone(self.cache.nearest([1.0, 0.0], "mistral", 0.95))
+        self.assertEqual(self.cache.stats()["similar_hits"], 1)
+
+
+class AIJobTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(generate_suggestions_task, "apply_async")
+        self.apply_async = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_duplicate_prompts_join_the_job_in_flight(self):
+        job_id = queue_suggestions("Spring launch", "llama3.2")
+        self.assertEqual(queue_suggestions("spring launch!", "llama3.2"), job_id)
+        self.assertNotEqual(queue_suggestions("Spring launch", "mistral"), job_id)
+        self.assertEqual(self.apply_async.call_count, 2)
+
+    def test_finished_job_releases_the_prompt(self):
+        job_id = queue_suggestions("Summer sale", "llama3.2")
+        suggestions = {"subject": "Hot deals", "body": "Hi"}
+        with mock.patch("users.tasks.generate_suggestions", return_value=suggestions):
+            result = generate_suggestions_task.apply(
+                args=("Summer sale", "llama3.2"), task_id=job_id
+            )
+        self.assertEqual(result.get(), suggestions)
+        self.assertNotEqual(queue_suggestions("Summer sale", "llama3.2"), job_id)
+
+
+class AIJobStatusTests(TestCase):
+    def setUp(self):
+        self.ann = CustomUser.objects.create_user("ann", "Secret!23")
+        self.bob = CustomUser.objects.create_user(
+            "bob", "Secret!23", email="b@gmail.com"
+        )
+        cache.clear()
+        patcher = mock.patch.object(generate_suggestions_task, "apply_async")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def queue(self, user, description):
+        request = APIRequestFactory().post(
+            "/api/users/ai-jobs/", {"description": description}, format="json"
+        )
+        force_authenticate(request, user=user)
+        return AIJobView.as_view()(request).data["job_id"]
+
+    def status(self, user, job_id):
+        request = APIRequestFactory().get(f"/api/users/ai-jobs/{job_id}/")
+        force_authenticate(request, user=user)
+        with mock.patch("users.views.AsyncResult") as async_result:
+            async_result.return_value.successful.return_value = True
+            async_result.return_value.result = {"subject": "Hi", "body": "Hello"}
+            return AIJobStatusView.as_view()(request, job_id=job_id)
+
+    def test_only_users_who_queued_a_job_can_read_it(self):
+        job_id = self.queue(self.ann, "Spring sale")
+
+        response = self.status(self.ann, job_id)
+        self.assertEqual(
+            response.data, {"status": "success", "subject": "Hi", "body": "Hello"}
+        )
+        self.assertEqual(self.status(self.bob, job_id).status_code, 404)
+        # Any other task id, such as a send chunk's, is not exposed either
+        self.assertEqual(self.status(self.ann, str(uuid.uuid4())).status_code, 404)
+
+    def test_users_joining_the_same_prompt_can_both_read_it(self):
+        job_id = self.queue(self.ann, "Spring sale")
+        self.assertEqual(self.queue(self.bob, "spring sale!"), job_id)
+        self.assertEqual(self.status(self.bob, job_id).status_code, 200)
@@ -0,0 +1,133 @@
+from collections import Counter
+from smtplib import SMTPRecipientsRefused, SMTPResponseException
+
+from django.conf import settings
+from django.utils import timezone
+
+from .counters import campaign_owner, record_status_changes
+from .models import DeadLetter, EmailTrack
+
+STATUS_FIELDS = ["status", "smtp_code", "smtp_response", "status_updated_at", "sent_at"]
+# Outcomes a track never leaves, so a resumed chunk must not send them again
+FINISHED_STATUSES = {"sent", "failed", "success", "fail"}
+
+
+def smtp_error_details(error):
+    # SMTP reply code and text carried by an smtplib exception, if any
+    if isinstance(error, SMTPRecipientsRefused) and error.recipients:
+        code, response = next(iter(error.recipients.values()))
+    elif isinstance(error, SMTPResponseException):
+        code, response = error.smtp_code, error.smtp_error
+    else:
+        return None, str(error)
+    if isinstance(response, bytes):
+        response = response.decode(errors="replace")
+    return code, response
+
+
+def is_transient_reply(code):
+    # 4xx replies (greylisting, a full mailbox, a busy server) may succeed
+    # later; 5xx replies and errors without a code won't
+    return code is not None and 400 <= code < 500
+
+
+def dead_letter(campaign_id, failures, attempts):
+    # Store recipients that ran out of retries. failures holds
+    # (track_id, email, body, smtp_code, smtp_response) tuples.
+    if not failures:
+        return
+    user_id = campaign_owner(campaign_id)
+    DeadLetter.objects.bulk_create(
+        [
+            DeadLetter(
+                username_id=user_id,
+                campaign_id=campaign_id,
+                track_id=track_id,
+                recipient=email,
+                body=body or "",
+                smtp_code=code,
+                smtp_response=response[:255],
+                attempts=attempts,
+            )
+            for track_id, email, body, code, response in failures
+        ]
+    )
+
+
+def mark_tracks(track_ids, status, smtp_response="", campaign_id=None):
+    # Move a whole set of recipients to one state with a single UPDATE.
+    # With a campaign, the counters move them out of their current states.
+    tracks = EmailTrack.objects.filter(id__in=track_ids)
+    changes = Counter()
+    if campaign_id:
+        for previous in tracks.values_list("status", flat=True):
+            changes[previous] -= 1
+            changes[status] += 1
+    tracks.update(
+        status=status,
+        smtp_response=smtp_response[:255],
+        status_updated_at=timezone.now(),
+    )
+    if changes:
+        record_status_changes(campaign_id, changes)
+
+
+def claim_tracks(track_ids, campaign_id=None):
+    """Mark a chunk's unfinished tracks as sending.
+
+    Returns ``{track_id: status}`` for the tracks that already reached a
+    final state, which a redelivered chunk must skip.
+    """
+    statuses = dict(
+        EmailTrack.objects.filter(id__in=track_ids).values_list("id", "status")
+    )
+    finished = {
+        track_id: status
+        for track_id, status in statuses.items()
+        if status in FINISHED_STATUSES
+    }
+    mark_tracks(
+        [track_id for track_id in statuses if track_id not in finished],
+        "sending",
+        campaign_id=campaign_id,
+    )
+    return finished
+
+
+class StatusBuffer:
+    """Collects per-recipient outcomes in the worker and writes them in batches.
+
+    Updates are flushed with one bulk_update every ``flush_size`` outcomes and
+    when the chunk finishes, so tracking costs a query per batch rather than
+    one per recipient. Every buffered track is expected to be ``sending``.
+    """
+
+    def __init__(self, campaign_id=None, flush_size=None):
+        self.campaign_id = campaign_id
+        self.flush_size = flush_size or settings.EMAIL_STATUS_FLUSH_SIZE
+        self.pending = []
+
+    def add(self, track_id, status, smtp_code=None, smtp_response=""):
+        now = timezone.now()
+        self.pending.append(
+            EmailTrack(
+                id=track_id,
+                status=status,
+                smtp_code=smtp_code,
+                smtp_response=smtp_response[:255],
+                status_updated_at=now,
+                sent_at=now if status == "sent" else None,
+            )
+        )
+        if len(self.pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        EmailTrack.objects.bulk_update(self.pending, STATUS_FIELDS)
+        if self.campaign_id:
+            changes = Counter(track.status for track in self.pending)
+            changes["sending"] -= len(self.pending)
+            record_status_changes(self.campaign_id, changes)
+        self.pending = []
@@ -0,0 +1,61 @@
+import logging
+
+import pandas as pd
+from django.conf import settings
+
+from .deliverability import get_deliverability_checker
+from .validators import check_email_addresses, validate_csv_columns
+
+logger = logging.getLogger(__name__)
+
+# Invalid addresses echoed back in the validation summary
+INVALID_SAMPLE_SIZE = 20
+
+
+def read_recipient_csv(file, chunksize=None):
+    # Every cell as text, so values are spooled and rendered exactly as uploaded
+    return pd.read_csv(file, dtype=str, keep_default_na=False, chunksize=chunksize)
+
+
+def spool_recipient_csv(file, path, chunksize=None):
+    """Validate a recipient CSV chunk by chunk and write accepted rows to path.
+
+    Only one chunk is held in memory at a time. Returns a summary dict, with
+    an ``errors`` list when the header is unusable.
+    """
+    chunksize = chunksize or settings.CSV_VALIDATION_CHUNK_SIZE
+    summary = {
+        "columns": [],
+        "total_rows": 0,
+        "valid_rows": 0,
+        "invalid_rows": 0,
+        "invalid_sample": [],
+        "errors": [],
+    }
+
+    # One MX lookup budget for the whole file, not one per chunk
+    mx_deadline = None
+    if settings.EMAIL_MX_CHECK:
+        mx_deadline = get_deliverability_checker().start_deadline()
+
+    with open(path, "w", newline="", encoding="utf-8") as spool:
+        for index, chunk in enumerate(read_recipient_csv(file, chunksize)):
+            if index == 0:
+                summary["columns"] = list(chunk.columns)
+                summary["errors"] = validate_csv_columns(chunk.columns)
+                if summary["errors"]:
+                    return summary
+
+            checked = check_email_addresses(chunk["email"], mx_deadline)
+            valid = checked["reason"] == ""
+            chunk[valid].to_csv(spool, header=index == 0, index=False)
+
+            summary["total_rows"] += len(chunk)
+            summary["valid_rows"] += int(valid.sum())
+            summary["invalid_rows"] += int((~valid).sum())
+            room = INVALID_SAMPLE_SIZE - len(summary["invalid_sample"])
+            if room > 0:
+                invalid = checked.loc[~valid, ["email", "reason"]].head(room)
+                summary["invalid_sample"].extend(invalid.to_dict(orient="records"))
+
+    return summary
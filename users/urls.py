@@ -2,6 +2,11 @@ from django.urls import path
 
 from .views import (
     AIGenerateSuggestionsView,
+    AIJobStatusView,
+    AIJobView,
+    AIPersonaliseView,
+    AISuggestionCacheMetricsView,
+    BulkSendEmailView,
     CheckAuthenticationView,
     CreateTemplateView,
     CSVUploadView,
@@ -10,11 +15,13 @@ from .views import (
     HomeView,
     LoginView,
     LogoutView,
+    QueueDepthView,
     RegisterView,
     SendEmailPageView,
     SendEmailView,
     SigninPageView,
     SignupPageView,
+    SuppressionListView,
     TemplateEditorView,
     UserTemplatesView,
     WelcomePageView,
@@ -33,7 +40,16 @@ urlpatterns = [
     path("create-template/", CreateTemplateView.as_view(), name="create-template"),
     path("template/", TemplateEditorView.as_view(), name="template-editor"),
     path("send-email/", SendEmailView.as_view(), name="send-email"),
+    path("bulk-send-email/", BulkSendEmailView.as_view(), name="bulk-send-email"),
     path("ai-suggestions/", AIGenerateSuggestionsView.as_view(), name="ai-suggestions"),
+    path("ai-jobs/", AIJobView.as_view(), name="ai-jobs"),
+    path("ai-personalise/", AIPersonaliseView.as_view(), name="ai-personalise"),
+    path("ai-jobs/<str:job_id>/", AIJobStatusView.as_view(), name="ai-job-status"),
+    path(
+        "ai-suggestions/metrics/",
+        AISuggestionCacheMetricsView.as_view(),
+        name="ai-suggestions-metrics",
+    ),
     path(
         "check-authentication/",
         CheckAuthenticationView.as_view(),
@@ -42,4 +58,6 @@ urlpatterns = [
     path("send-email-page/", SendEmailPageView.as_view(), name="send-email-page"),
     path("get-user-templates/", UserTemplatesView.as_view(), name="get-user-templates"),
     path("email-status/", EmailStatusView.as_view(), name="email-status"),
+    path("queues/", QueueDepthView.as_view(), name="queue-depth"),
+    path("suppressions/", SuppressionListView.as_view(), name="suppressions"),
 ]
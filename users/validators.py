@@ -1,7 +1,12 @@
 import re
 
+import numpy as np
+import pandas as pd
+from django.conf import settings
 from django.core.exceptions import ValidationError
 
+from .deliverability import get_deliverability_checker
+
 
 def validate_password_strength(password):
     if len(password) < 8:
@@ -18,3 +23,87 @@ def validate_password_strength(password):
 
     if not re.search(r'[!@#$%^&*(),.?":{}|<>]', password):
         raise ValidationError("Password must contain at least one special character.")
+
+
+# Simple email format, the captured group is the domain
+EMAIL_RE = re.compile(r"^[a-zA-Z0-9_.+-]+@([a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+)$")
+
+# Columns every recipient CSV must have, any others are template fields
+REQUIRED_CSV_COLUMNS = ["email", "first_name"]
+
+
+def check_email_addresses(emails, mx_deadline=None):
+    """Validate a whole column of addresses at once.
+
+    Returns a DataFrame with the ``email``, its lower-cased ``domain`` and a
+    ``reason`` that is empty for valid addresses. ``mx_deadline`` bounds the
+    MX lookups when one upload is checked over several calls.
+    """
+    emails = pd.Series(emails, dtype=object)
+
+    # One pass of the precompiled regex over the column
+    match = EMAIL_RE.match
+    domains = [
+        m.group(1) if (m := match(email)) else None
+        for email in emails.astype(str).tolist()
+    ]
+
+    # Lower-case and look up only the distinct domains, then broadcast back.
+    # Malformed addresses get code -1, which picks the appended sentinel.
+    codes, uniques = pd.factorize(pd.Series(domains, dtype=object))
+    uniques = uniques.str.lower()
+    if settings.ALLOWED_RECIPIENT_DOMAINS:
+        allowed = uniques.isin(settings.ALLOWED_RECIPIENT_DOMAINS)
+    else:
+        allowed = np.ones(len(uniques), dtype=bool)
+    # Domains that DNS says take no mail; unanswered lookups get the benefit
+    # of the doubt
+    undeliverable = np.zeros(len(uniques), dtype=bool)
+    if settings.EMAIL_MX_CHECK:
+        results = get_deliverability_checker().check(
+            uniques[allowed].tolist(), mx_deadline
+        )
+        undeliverable = np.asarray(
+            uniques.map(lambda d: results.get(d) is False), dtype=bool
+        )
+    allowed = np.append(allowed, False)
+    undeliverable = np.append(undeliverable, False)
+    domains = np.append(np.asarray(uniques, dtype=object), None)
+
+    reasons = np.select(
+        [codes < 0, ~allowed[codes], undeliverable[codes]],
+        [
+            "Invalid email format.",
+            "Email domain is not allowed.",
+            "Email domain does not accept mail.",
+        ],
+        default="",
+    )
+    return pd.DataFrame(
+        {"email": emails, "domain": domains[codes], "reason": reasons.astype(object)},
+        index=emails.index,
+    )
+
+
+def partition_email_addresses(emails):
+    # Valid addresses, and invalid ones as {"email", "reason"} records
+    checked = check_email_addresses(emails)
+    valid = (checked["reason"] == "").to_numpy()
+    addresses = checked["email"].to_numpy()
+    reasons = checked["reason"].to_numpy()
+    invalid = [
+        {"email": email, "reason": reason}
+        for email, reason in zip(addresses[~valid].tolist(), reasons[~valid].tolist())
+    ]
+    return addresses[valid].tolist(), invalid
+
+
+def validate_csv_columns(columns):
+    errors = []
+
+    # Check for missing required columns
+    for column in REQUIRED_CSV_COLUMNS:
+        if column not in columns:
+            errors.append(f"Missing required column: {column}")
+
+    return errors
@@ -1,21 +1,45 @@
+import binascii
+import heapq
+import json
 import logging
-import re
-import subprocess
+import os
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
 
+import httpx
 import pandas as pd
+from celery.result import AsyncResult
+from django.conf import settings
 from django.contrib.auth import authenticate, get_user_model, login, logout
 from django.core.exceptions import ValidationError
-from django.http import JsonResponse
+from django.db.models import Q
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.generic import TemplateView
+from kombu.exceptions import OperationalError
 from rest_framework import status
-from rest_framework.parsers import FormParser, MultiPartParser
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from .models import EmailTemplate, EmailTrack
-from .tasks import send_email_task
-from .validators import validate_password_strength
+from .ai import (
+    OllamaError,
+    generate_suggestions,
+    get_suggestion_cache,
+    iterate,
+    run,
+    stream_suggestions,
+)
+from .caching import EMAIL_STATUS, TEMPLATES, cached_response
+from .counters import user_status_counts
+from .models import AIJob, EmailTemplate, EmailTrack, RecipientUpload, Suppression
+from .queues import queue_depths
+from .rendering import compile_template, get_compiled_template
+from .screening import check_recipients
+from .suppression import add_suppressions
+from .tasks import personalise_campaign_task, queue_suggestions, start_campaign
+from .uploads import read_recipient_csv, spool_recipient_csv
+from .validators import validate_csv_columns, validate_password_strength
 
 logger = logging.getLogger(__name__)
 
@@ -137,23 +161,13 @@ class CSVValidationView(APIView):
             return JsonResponse({"error": "No file uploaded."}, status=400)
 
         try:
+            if request.data.get("mode") == "stream":
+                return self.stream_validate(request, file)
+
             # Read the CSV file using pandas
             df = pd.read_csv(file)
 
-            # Define required columns
-            required_columns = ["email", "first_name"]
-            errors = []
-
-            # Check for missing required columns
-            for column in required_columns:
-                if column not in df.columns:
-                    errors.append(f"Missing required column: {column}")
-
-            # Check for extra columns
-            extra_columns = [col for col in df.columns if col not in required_columns]
-            if extra_columns:
-                errors.append(f"Extra columns found: {', '.join(extra_columns)}")
-
+            errors = validate_csv_columns(df.columns)
             if errors:
                 return JsonResponse({"error": errors}, status=400)
 
@@ -168,6 +182,39 @@ class CSVValidationView(APIView):
         except Exception as e:
             return JsonResponse({"error": [str(e)]}, status=400)
 
+    def stream_validate(self, request, file):
+        # Validate in chunks and spool accepted rows instead of echoing them back
+        upload = RecipientUpload(username=request.user, file_name=file.name)
+        os.makedirs(settings.UPLOAD_SPOOL_DIR, exist_ok=True)
+        upload.spool_path = os.path.join(settings.UPLOAD_SPOOL_DIR, f"{upload.id}.csv")
+
+        saved = False
+        try:
+            summary = spool_recipient_csv(file, upload.spool_path)
+            errors = summary.pop("errors")
+            if errors:
+                return JsonResponse({"error": errors}, status=400)
+
+            upload.columns = summary["columns"]
+            upload.total_rows = summary["total_rows"]
+            upload.valid_rows = summary["valid_rows"]
+            upload.invalid_rows = summary["invalid_rows"]
+            upload.save()
+            saved = True
+        finally:
+            # Don't leave spool files behind for rejected uploads
+            if not saved and os.path.exists(upload.spool_path):
+                os.remove(upload.spool_path)
+
+        return JsonResponse(
+            {
+                "message": "File uploaded and validated successfully.",
+                "upload_id": str(upload.id),
+                **summary,
+            },
+            status=200,
+        )
+
 
 class CheckAuthenticationView(APIView):
     permission_classes = [IsAuthenticated]
@@ -243,70 +290,129 @@ class SendEmailView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        # Define valid domains
-        valid_domains = [
-            "gmail.com",
-            "yahoo.com",
-            "outlook.com",
-        ]
-
         # Get the current user
         user = request.user
 
-        # Validate email addresses
-        valid_emails = []
-        invalid_emails = []
-        for email in recipient_list:
-            try:
-                # Regular expression for simple email validation
-                regex = r"^[a-zA-Z0-9_.+-]+@([a-zAZ0-9-]+\.[a-zA-Z0-9-.]+)$"
-                # Simple email format validation
-                match = re.match(regex, email)
-                if match:
-                    domain = match.group(1)
-                    if domain in valid_domains:  # Check if domain is valid
-                        valid_emails.append(email)
-                    else:
-                        invalid_emails.append(email)
-                else:
-                    invalid_emails.append(email)
-            except Exception as e:
-                print("Error: ", e)
-                invalid_emails.append(email)
-
-        # Enqueue the email sending task using Celery
+        # Validate email addresses. Repeats, suppressed addresses and
+        # recipients at their frequency cap are reported, not sent.
+        valid, invalid = check_recipients(user.id, recipient_list)
+        valid_emails = [email for email, ok in zip(recipient_list, valid) if ok]
+        invalid_emails = [item["email"] for item in invalid]
+
+        # Enqueue the email sending tasks using Celery, chunked across workers
         try:
-            send_email_task.delay(subject, message, valid_emails)
-            # Log each valid email to EmailTrack model
-            for email in valid_emails:
-                EmailTrack.objects.create(
-                    username=user,
-                    recipient=email,
-                    status="success",
-                    subject=subject,
-                    message=message,
-                )
-            for email in invalid_emails:
-                EmailTrack.objects.create(
-                    username=user,
-                    recipient=email,
-                    status="fail",
-                    subject=subject,
-                    message=message,
-                )
+            campaign = start_campaign(user, subject, message, valid_emails, invalid)
         except Exception as e:
-            print("Error: ", e)
+            logger.exception("Error enqueueing email")
+            return Response(
+                {"error": f"An error occurred: {str(e)}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            )
 
         # Return the response showing emails sent and failed ones
         response_data = {
             "message": "Email sending started. Emails will be sent asynchronously.",
+            "campaign_id": campaign.id,
             "sent_to": valid_emails,
             "not_sent_to": invalid_emails,
+            "not_sent_reasons": invalid,
         }
 
         return Response(response_data, status=status.HTTP_200_OK)
 
 
+class BulkSendEmailView(APIView):
+    permission_classes = [IsAuthenticated]
+    parser_classes = (MultiPartParser, FormParser)
+
+    def post(self, request):
+        subject = request.data.get("subject")
+        template_id = request.data.get("template_id")
+        message = request.data.get("message")
+        file = request.FILES.get("file")
+        upload_id = request.data.get("upload_id")
+
+        if not subject or not (file or upload_id) or not (template_id or message):
+            return Response(
+                {"error": "Subject, template and CSV file are required."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        # A previously validated upload stands in for the CSV file
+        if upload_id:
+            try:
+                upload = RecipientUpload.objects.get(
+                    id=upload_id, username=request.user
+                )
+            except (RecipientUpload.DoesNotExist, ValidationError):
+                return Response(
+                    {"error": "Upload not found."}, status=status.HTTP_404_NOT_FOUND
+                )
+            file = upload.spool_path
+
+        # Use the stored template when one is given, else the message as template
+        template = None
+        if template_id:
+            try:
+                template = EmailTemplate.objects.get(
+                    id=template_id, username=request.user
+                )
+            except (EmailTemplate.DoesNotExist, ValueError):
+                return Response(
+                    {"error": "Template not found."}, status=status.HTTP_404_NOT_FOUND
+                )
+            message = template.created_template
+            compiled = get_compiled_template(template)
+        else:
+            compiled = compile_template(message)
+
+        try:
+            df = read_recipient_csv(file)
+        except Exception as e:
+            return Response({"error": [str(e)]}, status=status.HTTP_400_BAD_REQUEST)
+
+        errors = validate_csv_columns(df.columns)
+        if errors:
+            return Response({"error": errors}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Invalid, repeated, suppressed and capped recipients are reported
+        valid, invalid = check_recipients(request.user.id, df["email"])
+        invalid_emails = [item["email"] for item in invalid]
+
+        # Render every recipient's message here and enqueue the batch once
+        rows = df[valid].to_dict(orient="records")
+        bodies = [compiled.render(row) for row in rows]
+        valid_emails = [row["email"] for row in rows]
+
+        try:
+            campaign = start_campaign(
+                request.user,
+                subject,
+                message,
+                valid_emails,
+                invalid,
+                bodies,
+                template,
+            )
+        except Exception as e:
+            logger.exception("Error enqueueing bulk email")
+            return Response(
+                {"error": f"An error occurred: {str(e)}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            )
+
+        return Response(
+            {
+                "message": "Email sending started. Emails will be sent asynchronously.",
+                "campaign_id": campaign.id,
+                "sent_count": len(valid_emails),
+                "not_sent_to": invalid_emails,
+                "not_sent_reasons": invalid,
+            },
+            status=status.HTTP_200_OK,
+        )
+
+
 class AIGenerateSuggestionsView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -319,46 +425,214 @@ class AIGenerateSuggestionsView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
+        # Stream tokens as newline-delimited JSON when the browser asks for it.
+        # A plain generator, so WSGI servers send each line as it's produced.
+        if request.data.get("stream"):
+            return StreamingHttpResponse(
+                self.ndjson(iterate(stream_suggestions(description))),
+                content_type="application/x-ndjson",
+            )
+
         # Generate AI email subject and body via Ollama
         try:
-            subject = self.generate_email_subject(description)
-            body = self.generate_email_body(description)
+            suggestions = run(generate_suggestions(description))
+            return Response(suggestions, status=status.HTTP_200_OK)
+
+        except (httpx.HTTPError, OllamaError) as e:
+            return Response(
+                {"error": f"Error generating content: {str(e)}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            )
+
+    def ndjson(self, events):
+        try:
+            for event in events:
+                yield json.dumps(event) + "\n"
+            yield json.dumps({"done": True}) + "\n"
+        finally:
+            # Stops generation when the browser goes away mid-stream
+            events.close()
+
+
+class AIJobView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        description = request.data.get("description")
+
+        if not description:
+            return Response(
+                {"error": "Description is required for generating suggestions."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        # Generated by a worker on the ai queue; poll AIJobStatusView for it
+        job_id = queue_suggestions(description)
+        AIJob.objects.get_or_create(job_id=job_id, username=request.user)
+        return Response({"job_id": job_id}, status=status.HTTP_202_ACCEPTED)
+
+
+class AIPersonaliseView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        subject = request.data.get("subject")
+        description = request.data.get("description")
+        template_id = request.data.get("template_id")
+        message = request.data.get("message")
+        upload_id = request.data.get("upload_id")
+
+        if not subject or not description or not upload_id:
+            return Response(
+                {"error": "Subject, description and upload_id are required."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if not (template_id or message):
+            return Response(
+                {"error": "A template or message is required."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            upload = RecipientUpload.objects.get(id=upload_id, username=request.user)
+        except (RecipientUpload.DoesNotExist, ValidationError):
+            return Response(
+                {"error": "Upload not found."}, status=status.HTTP_404_NOT_FOUND
+            )
+        if template_id:
+            try:
+                template_id = EmailTemplate.objects.get(
+                    id=template_id, username=request.user
+                ).id
+            except (EmailTemplate.DoesNotExist, ValueError):
+                return Response(
+                    {"error": "Template not found."}, status=status.HTTP_404_NOT_FOUND
+                )
+
+        # Generated on the ai queue; poll AIJobStatusView for the campaign id
+        job = personalise_campaign_task.delay(
+            request.user.id,
+            str(upload.id),
+            subject,
+            description,
+            message,
+            template_id,
+        )
+        AIJob.objects.create(job_id=job.id, username=request.user)
+        return Response({"job_id": job.id}, status=status.HTTP_202_ACCEPTED)
+
+
+class AIJobStatusView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, job_id):
+        # Only jobs the user queued, not any task id the result backend knows
+        if not AIJob.objects.filter(job_id=job_id, username=request.user).exists():
+            return Response(
+                {"error": "Job not found."}, status=status.HTTP_404_NOT_FOUND
+            )
+        result = AsyncResult(job_id)
+        if result.successful():
+            return Response(
+                {"status": "success", **result.result}, status=status.HTTP_200_OK
+            )
+        if result.failed():
             return Response(
                 {
-                    "subject": subject,
-                    "body": body,
+                    "status": "failed",
+                    "error": f"Error generating content: {str(result.result)}",
                 },
                 status=status.HTTP_200_OK,
             )
+        # PENDING (queued, or an unknown id) or STARTED
+        return Response({"status": result.state.lower()}, status=status.HTTP_200_OK)
 
-        except Exception as e:
+
+class AISuggestionCacheMetricsView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        # Hit and miss counts of this process's suggestion cache
+        return Response(get_suggestion_cache().stats(), status=status.HTTP_200_OK)
+
+
+class QueueDepthView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        try:
+            return Response(queue_depths(), status=status.HTTP_200_OK)
+        except OperationalError as e:
             return Response(
-                {"error": f"Error generating content: {str(e)}"},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                {"error": f"Broker unavailable: {str(e)}"},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
             )
 
-    def generate_email_subject(self, description):
-        return self.generate_with_ollama(
-            f"Generate a one-line email subject within 10 words for: : {description}"
-        )
 
-    def generate_email_body(self, description):
-        return self.generate_with_ollama(
-            f"Do not create subject. Write an email body for: {description}"
+class SuppressionListView(APIView):
+    permission_classes = [IsAuthenticated]
+    parser_classes = (JSONParser, MultiPartParser, FormParser)
+
+    def get(self, request):
+        # Export the user's list as CSV, in the same shape import accepts
+        rows = (
+            Suppression.objects.filter(username=request.user)
+            .order_by("email")
+            .values_list("email", "reason", "created_at")
         )
+        df = pd.DataFrame(list(rows), columns=["email", "reason", "created_at"])
+        response = HttpResponse(df.to_csv(index=False), content_type="text/csv")
+        response["Content-Disposition"] = 'attachment; filename="suppressions.csv"'
+        return response
+
+    def post(self, request):
+        # Import a CSV file with an email column, or a JSON list of emails.
+        # A reason column, as in the export, overrides the request's reason.
+        file = request.FILES.get("file")
+        reason = request.data.get("reason", "manual")
+        if reason not in dict(Suppression.REASON_CHOICES):
+            return Response(
+                {"error": "Unknown suppression reason."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        if not file:
+            emails = request.data.get("emails")
+            if not isinstance(emails, list) or not emails:
+                return Response(
+                    {"error": "A CSV file or a list of emails is required."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            added = add_suppressions(request.user.id, emails, reason)
+            return Response({"added": added}, status=status.HTTP_200_OK)
 
-    def generate_with_ollama(self, prompt):
-        # Run the Ollama command in subprocess
         try:
-            result = subprocess.run(
-                ["ollama", "run", "llama3.2", prompt],
-                capture_output=True,
-                text=True,
-                check=True,
+            df = read_recipient_csv(file)
+        except Exception as e:
+            return Response({"error": [str(e)]}, status=status.HTTP_400_BAD_REQUEST)
+        if "email" not in df.columns:
+            return Response(
+                {"error": ["Missing required column: email"]},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        if "reason" in df.columns:
+            # Rows without a reason take the request's
+            reasons = df["reason"].str.strip().str.lower().replace("", reason)
+        else:
+            reasons = pd.Series(reason, index=df.index)
+        unknown = sorted(set(reasons) - set(dict(Suppression.REASON_CHOICES)))
+        if unknown:
+            return Response(
+                {"error": f"Unknown suppression reason: {', '.join(unknown)}."},
+                status=status.HTTP_400_BAD_REQUEST,
             )
-            return result.stdout.strip()
-        except subprocess.CalledProcessError as e:
-            raise Exception(f"Error running Ollama: {str(e)}")
+
+        added = sum(
+            add_suppressions(request.user.id, df.loc[reasons == value, "email"], value)
+            for value in reasons.unique()
+        )
+        return Response({"added": added}, status=status.HTTP_200_OK)
 
 
 class UserTemplatesView(APIView):
@@ -367,14 +641,19 @@ class UserTemplatesView(APIView):
     def get(self, request):
         try:
             # Get all templates for the current logged-in user
-            templates = EmailTemplate.objects.filter(username=request.user)
-
-            template_data = [
-                {"id": template.id, "created_template": template.created_template}
-                for template in templates
-            ]
-
-            return Response({"templates": template_data}, status=status.HTTP_200_OK)
+            def template_data():
+                templates = EmailTemplate.objects.filter(username=request.user)
+                return {
+                    "templates": [
+                        {
+                            "id": template.id,
+                            "created_template": template.created_template,
+                        }
+                        for template in templates
+                    ]
+                }
+
+            return cached_response(request, TEMPLATES, template_data)
 
         except Exception as e:
             logger.error(
@@ -392,28 +671,127 @@ class EmailStatusView(APIView):
     def get(self, request):
         # Get the current user
         user = request.user
+        include_message = request.query_params.get("include_message") == "true"
+        page_size = request.query_params.get(
+            "page_size", settings.EMAIL_STATUS_PAGE_SIZE
+        )
+        try:
+            page_size = min(int(page_size), settings.EMAIL_STATUS_MAX_PAGE_SIZE)
+            cursor = decode_status_cursor(request.query_params.get("cursor"))
+        except ValueError:
+            return Response({"error": "Invalid page_size or cursor."}, status=400)
+        page_size = max(page_size, 1)
+
+        group = request.query_params.get("status")
+        if group and group not in EmailTrack.STATUS_GROUPS:
+            return Response({"error": f"Unknown status '{group}'."}, status=400)
+
+        return cached_response(
+            request,
+            EMAIL_STATUS,
+            lambda: self.status_data(user, group, cursor, page_size, include_message),
+        )
 
-        # Query the EmailTrack model for the current user's email statuses
-        successful_emails = EmailTrack.objects.filter(username=user, status="success")
-        failed_emails = EmailTrack.objects.filter(username=user, status="fail")
+    def status_data(self, user, group, cursor, page_size, include_message):
+        # One listing at a time when paging through a status group
+        if group:
+            emails, next_cursor = self.email_page(
+                user, group, cursor, page_size, include_message
+            )
+            return {"emails": emails, "next": next_cursor}
 
-        # Count the number of successful and failed emails
-        success_count = successful_emails.count()
-        fail_count = failed_emails.count()
+        # Kept up to date by the send path and workers, so no EmailTrack scan
+        counts = user_status_counts(user)
 
-        # Get the details of successful and failed emails
-        success_list = successful_emails.values(
-            "recipient", "subject", "email_sent_date", "message"
+        successful_emails, successful_next = self.email_page(
+            user, "success", None, page_size, include_message
         )
-        fail_list = failed_emails.values(
-            "recipient", "subject", "email_sent_date", "message"
+        failed_emails, failed_next = self.email_page(
+            user, "fail", None, page_size, include_message
         )
 
-        response_data = {
-            "success_count": success_count,
-            "fail_count": fail_count,
-            "successful_emails": list(success_list),
-            "failed_emails": list(fail_list),
+        return {
+            "success_count": counts["success"],
+            "fail_count": counts["fail"],
+            # Still with the workers: queued, sending or deferred for a retry
+            "pending_count": counts["pending"],
+            "successful_emails": successful_emails,
+            "successful_next": successful_next,
+            "failed_emails": failed_emails,
+            "failed_next": failed_next,
+        }
+
+    def email_page(self, user, group, cursor, page_size, include_message):
+        # Newest first, keyed on (email_sent_date, id) so deep pages cost the
+        # same as the first one. Each status of the group is read in index
+        # order and the sorted runs merged, rather than having the database
+        # sort the rows of all of them.
+        fields = [
+            "id",
+            "recipient",
+            "subject",
+            "email_sent_date",
+            "campaign__subject",
+            "status",
+            "smtp_code",
+            "smtp_response",
+            "sent_at",
+        ]
+        if include_message:
+            fields += ["message", "campaign__body"]
+
+        runs = []
+        for track_status in EmailTrack.STATUS_GROUPS[group]:
+            tracks = EmailTrack.objects.filter(
+                username=user, status=track_status
+            ).order_by("-email_sent_date", "-id")
+            if cursor:
+                sent_date, track_id = cursor
+                tracks = tracks.filter(
+                    Q(email_sent_date__lt=sent_date)
+                    | Q(email_sent_date=sent_date, id__lt=track_id)
+                )
+            # One extra row tells whether there is a next page
+            runs.append(list(tracks.values(*fields)[: page_size + 1]))
+        rows = list(
+            heapq.merge(
+                *runs, key=lambda row: (row["email_sent_date"], row["id"]), reverse=True
+            )
+        )[: page_size + 1]
+
+        next_cursor = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursor = encode_status_cursor(rows[-1])
+
+        return [self.email_details(row, include_message) for row in rows], next_cursor
+
+    def email_details(self, row, include_message):
+        # Subject and message live on the campaign, legacy rows carry their own
+        details = {
+            "recipient": row["recipient"],
+            "subject": row["subject"] or row["campaign__subject"],
+            "email_sent_date": row["email_sent_date"],
+            "status": row["status"],
+            "smtp_code": row["smtp_code"],
+            "smtp_response": row["smtp_response"],
+            "sent_at": row["sent_at"],
         }
+        if include_message:
+            details["message"] = row["message"] or row["campaign__body"]
+        return details
+
+
+def encode_status_cursor(row):
+    position = f"{row['email_sent_date'].isoformat()}|{row['id']}"
+    return urlsafe_b64encode(position.encode()).decode()
+
 
-        return Response(response_data, status=200)
+def decode_status_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        sent_date, track_id = urlsafe_b64decode(cursor).decode().split("|")
+        return datetime.fromisoformat(sent_date), int(track_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e